@@ -0,0 +1,392 @@
+"""
+This module contains benchmarks for the to-do app. They run offline and do not
+need any credentials. The operations on to-do lists run against
+FakeSpreadsheet, an in-memory stand-in for a gspread spreadsheet, which can
+add latency to every API call and reject calls over a quota, as Google Sheets
+does. Run them with: python3 benchmark.py [--sizes 10,1000] [--latency MS]
+[--quota CALLS_PER_MINUTE]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import re
+import threading
+import time
+import tracemalloc
+import gspread
+import storage
+from run import (SORT_CHOICES, Task, TaskCache, TaskHandler, numpy,
+                 sort_order, sort_tasks_by)
+
+
+class LegacyTask:
+    """
+    The Task class as it was before the fields moved into slots, kept to
+    compare the memory use of the two classes.
+    """
+    def __init__(self, task_name, description=None, due_date=None,
+                 priority=10):
+        self.task_name = task_name
+        self.description = description
+        self.due_date = due_date
+        self.priority = priority
+
+
+class FakeResponse:
+    """
+    The part of an HTTP response which gspread.exceptions.APIError reads
+    """
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+
+    def json(self):
+        """
+        Returns the error body of the response
+        """
+        return {'error': {'code': self.status_code, 'message': self.text,
+                          'status': 'RESOURCE_EXHAUSTED'}}
+
+
+class FakeApi:
+    """
+    Class simulating the cost and the limits of the Google Sheets API. Every
+    call sleeps latency seconds and is counted. With a quota, calls beyond
+    quota calls in the last 60 seconds fail with HTTP 429, as the real API
+    does.
+    """
+    def __init__(self, latency=0.0, quota=None):
+        self.latency = latency
+        self.quota = quota
+        self.calls = 0
+        self.recent = []
+        self.lock = threading.Lock()
+
+    def call(self):
+        """
+        Count an API call, sleep for the latency and apply the quota
+        """
+        with self.lock:
+            self.calls += 1
+            now = time.monotonic()
+            if self.quota is not None:
+                self.recent = [moment for moment in self.recent
+                               if now - moment < 60]
+                if len(self.recent) >= self.quota:
+                    raise gspread.exceptions.APIError(
+                        FakeResponse(429, 'Quota exceeded'))
+                self.recent.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeWorksheet:
+    """
+    In-memory stand-in for a gspread Worksheet, implementing the calls the
+    storage backend makes. Rows count from 1 as in gspread and every cell
+    is kept as a string.
+    """
+    def __init__(self, api, title, rows=None):
+        self.api = api
+        self.title = title
+        self.rows = rows or []
+
+    @staticmethod
+    def parse_range(range_name):
+        """
+        Returns the first row, last row, first column and last column of a
+        range such as A2:E10, A2:A or F1, counted from 0, where the last row
+        is None for a range to the end of the worksheet
+        """
+        first_column, first_row, last_column, last_row = re.fullmatch(
+            r'([A-Z])(\d+)(?::([A-Z])(\d*))?', range_name).groups()
+        if last_column is None:
+            last_column, last_row = first_column, first_row
+        return (int(first_row) - 1, int(last_row) - 1 if last_row else None,
+                ord(first_column) - ord('A'), ord(last_column) - ord('A'))
+
+    def values(self, range_name):
+        """
+        Returns the values of a range as the API does, without the empty
+        cells at the end of a row and the empty rows at the end
+        """
+        first_row, last_row, first_column, last_column = \
+            self.parse_range(range_name)
+        end = None if last_row is None else last_row + 1
+        values = []
+        for row in self.rows[first_row:end]:
+            cells = row[first_column:last_column + 1]
+            while cells and not cells[-1]:
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def get_all_values(self):
+        self.api.call()
+        return [list(row) for row in self.rows]
+
+    def get(self, range_name):
+        self.api.call()
+        return self.values(range_name)
+
+    def batch_get(self, ranges):
+        self.api.call()
+        return [self.values(range_name) for range_name in ranges]
+
+    def append_row(self, row):
+        self.api.call()
+        self.rows.append(storage.clean_row(row))
+
+    def append_rows(self, rows):
+        self.api.call()
+        self.rows.extend(storage.clean_row(row) for row in rows)
+
+    def insert_row(self, row, index=1):
+        self.api.call()
+        self.rows.insert(index - 1, storage.clean_row(row))
+
+    def clear(self):
+        self.api.call()
+        self.rows = []
+
+    def resize(self, rows=None):
+        self.api.call()
+        del self.rows[rows:]
+
+    def update(self, range_name='A1', values=()):
+        self.api.call()
+        self.set_cells(range_name, values)
+
+    def batch_update(self, data):
+        self.api.call()
+        for item in data:
+            self.set_cells(item['range'], item['values'])
+
+    def set_cells(self, range_name, values):
+        """
+        Overwrite the cells from the top left cell of range_name with values
+        """
+        first_row, _, first_column, _ = self.parse_range(range_name)
+        for number, row in enumerate(values, first_row):
+            while len(self.rows) <= number:
+                self.rows.append([])
+            cells = self.rows[number]
+            cells.extend([''] * (first_column + len(row) - len(cells)))
+            cells[first_column:first_column + len(row)] = \
+                storage.clean_row(row)
+
+    def delete_rows(self, start, end=None):
+        self.api.call()
+        del self.rows[start - 1:end or start]
+
+
+class FakeSpreadsheet:
+    """
+    In-memory stand-in for a gspread Spreadsheet holding FakeWorksheets
+    """
+    def __init__(self, api):
+        self.api = api
+        self.sheets = {}
+
+    def worksheets(self):
+        self.api.call()
+        return list(self.sheets.values())
+
+    def worksheet(self, title):
+        self.api.call()
+        if title not in self.sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.api.call()
+        worksheet = FakeWorksheet(self.api, title)
+        self.sheets[title] = worksheet
+        return worksheet
+
+    def del_worksheet(self, worksheet):
+        self.api.call()
+        del self.sheets[worksheet.title]
+
+    def values_batch_get(self, ranges):
+        self.api.call()
+        value_ranges = []
+        for range_name in ranges:
+            title = range_name.rpartition('!')[0].strip("'").replace("''",
+                                                                     "'")
+            value_ranges.append({'range': range_name,
+                                 'values': self.sheets[title].rows[1:]})
+        return {'valueRanges': value_ranges}
+
+
+def make_rows(count):
+    """
+    Returns count task rows as they are read from a worksheet
+    """
+    return [[f'task {number}', f'description {number}',
+             f'{number % 28 + 1:02d}/{number % 12 + 1:02d}/24',
+             str(number % 10 + 1)] for number in range(count)]
+
+
+def measure_task_memory(task_class, rows):
+    """
+    Returns the number of bytes allocated when creating one task_class
+    instance for each row. The strings of the rows exist before measuring,
+    so only the memory of the task objects and their parsed fields counts.
+    """
+    gc.collect()
+    tracemalloc.start()
+    tasks = [task_class(*row) for row in rows]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tasks
+    return size
+
+
+def benchmark_task_memory(count=100000):
+    """
+    Print the memory used by count tasks with the legacy and the current
+    Task class
+    """
+    rows = make_rows(count)
+    legacy = measure_task_memory(LegacyTask, rows)
+    current = measure_task_memory(Task, rows)
+    print(f'Task memory for {count} tasks:')
+    print(f'LegacyTask: {legacy / 1e6:.1f} MB '
+          f'({legacy / count:.0f} bytes per task)')
+    print(f'Task: {current / 1e6:.1f} MB '
+          f'({current / count:.0f} bytes per task)')
+
+
+def benchmark_sort(count=100000):
+    """
+    Print the time it takes to sort count tasks with every sorting choice
+    """
+    tasks = [Task(*row) for row in make_rows(count)]
+    engine = 'NumPy' if numpy is not None else 'Python'
+    print(f'Sorting {count} tasks ({engine}):')
+    for keys in SORT_CHOICES.values():
+        start = time.perf_counter()
+        sort_order(tasks, keys)
+        elapsed = time.perf_counter() - start
+        print(f'{", ".join(keys)}: {elapsed * 1000:.1f} ms')
+
+
+def measure(api, operation, cache):
+    """
+    Returns the wall time in milliseconds and the number of API calls of
+    running operation(), and whether it succeeded: it raised no storage
+    error and left no unsaved changes in cache. Messages printed by the
+    handlers are hidden.
+    """
+    calls = api.calls
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            operation()
+        succeeded = not cache.is_dirty()
+    except storage.StorageError:
+        succeeded = False
+    return (time.perf_counter() - start) * 1000, api.calls - calls, succeeded
+
+
+def refresh(handler):
+    """
+    Load the tasks of the handler, checking the worksheet for changes
+    """
+    handler.cache.checked_at = 0
+    handler.load_tasks()
+
+
+def benchmark_operations(sizes, latency=0.0, quota=None):
+    """
+    Print the wall time and the API calls of loading a list, of adding,
+    updating, deleting and sorting one task and of checking the list for
+    changes, in lists of every size in sizes, through a TaskHandler working
+    on a FakeSpreadsheet. Changes are written immediately, as in the app by
+    default.
+    """
+    api = FakeApi(latency, quota)
+    sheet = storage.GspreadStorage(FakeSpreadsheet(api))
+    print(f'Task operations (latency {latency * 1000:.0f} ms per call, '
+          f'quota {quota or "none"}):')
+    print(f'{"tasks":>7} {"operation":<8} {"ms":>10} {"API calls":>10} '
+          f'{"saved":>6}')
+    for count in sizes:
+        name = f'benchmark {count}'
+        try:
+            worksheet = sheet.create_list(name)
+        except storage.StorageError as e:
+            print(f'{count:>7} could not create the list: {e}')
+            continue
+        worksheet.worksheet.rows.extend(
+            [name] + row for row in make_rows(count))
+        handler = TaskHandler(None, None, None)
+        handler.worksheet = worksheet
+        handler.cache = TaskCache.for_worksheet(worksheet)
+        middle = f'task {count // 2}'
+        operations = [
+            ('load', lambda: handler.load_tasks(force=True)),
+            ('add', lambda: handler.add_task(
+                ('new task', '', '01/01/25', 1), name, worksheet)),
+            ('update', lambda: handler.save_changes(
+                handler.cache.mark_dirty, handler.find_task_by_name(middle))),
+            ('delete', lambda: handler.delete_task(middle)),
+            ('sort', lambda: handler.save_changes(
+                handler.cache.reorder,
+                sort_tasks_by(handler.tasks, SORT_CHOICES['4']))),
+            # Checks for changes by others, after the writes and when idle
+            ('refresh', lambda: refresh(handler)),
+            ('idle', lambda: refresh(handler)),
+        ]
+        for operation, run_operation in operations:
+            elapsed, calls, succeeded = measure(api, run_operation,
+                                                handler.cache)
+            print(f'{count:>7} {operation:<8} {elapsed:>10.1f} {calls:>10} '
+                  f'{"yes" if succeeded else "no":>6}')
+        TaskCache.drop(name)
+        # The list is removed directly, as the quota may be used up
+        del sheet.spreadsheet.sheets[name]
+        sheet.invalidate()
+
+
+def parse_arguments():
+    """
+    Returns the parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks of the to-do '
+                                     'app, run without credentials.')
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+                        help='comma separated list sizes of the operation '
+                        'benchmark')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds added to every API call')
+    parser.add_argument('--quota', type=int, default=None,
+                        help='API calls allowed per minute, calls beyond it '
+                        'fail with HTTP 429')
+    parser.add_argument('--operations-only', action='store_true',
+                        help='skip the memory and sorting benchmarks')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Run all benchmarks
+    """
+    arguments = parse_arguments()
+    # The fake API applies its own quota, so the client side rate limiter
+    # would only slow the benchmark down
+    storage.RATE_LIMITER = None
+    TaskCache.default_policy = ('immediate', None)
+    if not arguments.operations_only:
+        benchmark_task_memory()
+        benchmark_sort()
+    sizes = [int(size) for size in arguments.sizes.split(',')]
+    benchmark_operations(sizes, arguments.latency / 1000, arguments.quota)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,84 @@
-const Pty = require('node-pty');
+const net = require('net');
+const { spawn } = require('child_process');
 const fs = require('fs');
 
+// All terminals are sessions of one Python server listening on this socket
+const SOCKET = process.env.TODO_SERVER_SOCKET || 'todo.sock';
+// Tries to connect while the server is starting, 250 ms apart
+const CONNECT_ATTEMPTS = 40;
+// A stopped server is started again after this many ms, doubled every time
+// it stops again within a minute, up to a minute
+const RESTART_DELAY = 1000;
+const MAX_RESTART_DELAY = 60000;
+
 exports.install = function () {
 
     ROUTE('/');
     WEBSOCKET('/', socket, ['raw']);
+    startServer();
 
 };
 
+function startServer(delay) {
+
+    const started = Date.now();
+    const server = spawn('python3', ['server.py', '--socket', SOCKET], {
+        cwd: process.env.PWD,
+        env: process.env,
+        stdio: 'inherit'
+    });
+
+    server.on('exit', function (code, signal) {
+        console.log("Session server stopped", code, signal);
+        // Start it again, so later connections do not fail
+        let next = RESTART_DELAY;
+        if (delay && Date.now() - started < MAX_RESTART_DELAY) {
+            next = Math.min(delay * 2, MAX_RESTART_DELAY);
+        }
+        console.log("Restarting the session server in", next, "ms");
+        setTimeout(function () {
+            startServer(next);
+        }, next);
+    });
+
+}
+
+function connect(client, attempts) {
+
+    const conn = net.connect(SOCKET);
+    let connected = false;
+    conn.setEncoding('utf8');
+
+    conn.on('connect', function () {
+        connected = true;
+        client.conn = conn;
+    });
+
+    conn.on('data', function (data) {
+        client.send(data);
+    });
+
+    conn.on('error', function (err) {
+        if (!connected && attempts > 0 && !client.closed) {
+            setTimeout(function () {
+                connect(client, attempts - 1);
+            }, 250);
+        } else {
+            console.log("Session connection error: ", err.message);
+            client.close();
+        }
+    });
+
+    conn.on('close', function (hadError) {
+        if (connected) {
+            client.conn = null;
+            client.close();
+            console.log("Session ended");
+        }
+    });
+
+}
+
 function socket() {
 
     this.encodedecode = false;
@@ -15,37 +86,22 @@ function socket() {
 
     this.on('open', function (client) {
 
-        // Spawn terminal
-        client.tty = Pty.spawn('python3', ['run.py'], {
-            name: 'xterm-color',
-            cols: 80,
-            rows: 24,
-            cwd: process.env.PWD,
-            env: process.env
-        });
-
-        client.tty.on('exit', function (code, signal) {
-            client.tty = null;
-            client.close();
-            console.log("Process killed");
-        });
-
-        client.tty.on('data', function (data) {
-            client.send(data);
-        });
+        // Start a session in the session server
+        connect(client, CONNECT_ATTEMPTS);
 
     });
 
     this.on('close', function (client) {
-        if (client.tty) {
-            client.tty.kill(9);
-            client.tty = null;
-            console.log("Process killed and terminal unloaded");
+        client.closed = true;
+        if (client.conn) {
+            client.conn.end();
+            client.conn = null;
+            console.log("Session closed and terminal unloaded");
         }
     });
 
     this.on('message', function (client, msg) {
-        client.tty && client.tty.write(msg);
+        client.conn && client.conn.write(msg);
     });
 }
 
@@ -57,4 +113,4 @@ if (process.env.CREDS != null) {
             socket.emit("console_output", "Error saving credentials: " + err);
         }
     });
-}
\ No newline at end of file
+}
@@ -0,0 +1,397 @@
+"""
+This module contains the instrumentation of the to-do app. When the
+environment variable TODO_METRICS is set to json or prometheus, the time of
+every handler method and every Google Sheets API call is recorded in latency
+histograms, with the number of API calls and cells sent and received. The
+metrics are written to TODO_METRICS_PATH every TODO_METRICS_INTERVAL seconds
+(60 by default) and when the program exits: as one JSON line per export, or
+as a Prometheus text file which is replaced on every export. When
+TODO_COUNT_API_CALLS is set, the number of API calls of the latest run of
+every operation and their total are printed when the program exits. When
+neither is set the handler methods are not wrapped at all.
+"""
+import atexit
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+import types
+from datetime import datetime, timezone
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DEFAULT_PATHS = {'json': 'todo-metrics.jsonl',
+                 'prometheus': 'todo-metrics.prom'}
+
+
+class Histogram:
+    """
+    Class counting observed durations in the BUCKETS, with their count and
+    their sum, as a Prometheus histogram does
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        """
+        Add one duration in seconds
+        """
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def cumulative(self):
+        """
+        Returns (upper bound, count of durations up to it) for every bucket,
+        ending with '+Inf' and the total count
+        """
+        bounds = [str(bound) for bound in BUCKETS] + ['+Inf']
+        counts = []
+        running = 0
+        for count in self.buckets:
+            running += count
+            counts.append(running)
+        return list(zip(bounds, counts))
+
+    def to_dict(self):
+        """
+        Returns the histogram as a dictionary for JSON
+        """
+        return {'count': self.count, 'sum': round(self.total, 6),
+                'buckets': dict(self.cumulative())}
+
+
+class Operation:
+    """
+    Metrics of one handler method: its latency, the errors it raised and the
+    API calls and cells of the calls made while it was the innermost
+    method running, with the API calls of its latest run
+    """
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.api_calls = 0
+        self.last_api_calls = 0
+        self.cells = 0
+
+    def to_dict(self):
+        """
+        Returns the metrics as a dictionary for JSON
+        """
+        return dict(self.latency.to_dict(), errors=self.errors,
+                    api_calls=self.api_calls, cells=self.cells)
+
+
+class ApiMethod:
+    """
+    Metrics of one gspread method: the latency of every request and the
+    cells sent and received
+    """
+    def __init__(self):
+        self.latency = Histogram()
+        self.cells_sent = 0
+        self.cells_received = 0
+
+    def to_dict(self):
+        """
+        Returns the metrics as a dictionary for JSON
+        """
+        return dict(self.latency.to_dict(), cells_sent=self.cells_sent,
+                    cells_received=self.cells_received)
+
+
+class Metrics:
+    """
+    Class collecting the metrics of the app and writing them to a file.
+    Nothing is recorded unless it is enabled, which it is when output is
+    'json' or 'prometheus', or when count_api_calls is True. The metrics
+    are only written to a file when there is an output.
+    """
+    def __init__(self, output=None, path=None, interval=60,
+                 count_api_calls=False):
+        if output not in (None, 'json', 'prometheus'):
+            raise ValueError(f'Unknown metrics output: {output}')
+        self.output = output
+        self.enabled = output is not None or count_api_calls
+        self.path = path or DEFAULT_PATHS.get(output)
+        self.interval = interval
+        self.operations = {}
+        self.api_methods = {}
+        self.lock = threading.Lock()
+        # The innermost instrumented method running in each thread
+        self.local = threading.local()
+        self.exporter = None
+        self.stopped = threading.Event()
+        # Exceptions which are not counted as errors, such as those used to
+        # leave a menu
+        self.ignored_errors = ()
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Returns Metrics configured by the TODO_METRICS variables. An
+        unknown output turns metrics off and an invalid interval is
+        replaced with 60 seconds, with a warning.
+        """
+        output = os.environ.get('TODO_METRICS') or None
+        if output not in (None, 'json', 'prometheus'):
+            print(f'Invalid metrics output {output}. Use json or '
+                  'prometheus. Metrics are turned off.')
+            output = None
+        interval = os.environ.get('TODO_METRICS_INTERVAL', '60')
+        try:
+            interval = float(interval)
+            if interval <= 0:
+                raise ValueError
+        except ValueError:
+            if output is not None:
+                print(f'Invalid metrics interval {interval}. Metrics are '
+                      'written every 60 seconds.')
+            interval = 60
+        return cls(output, os.environ.get('TODO_METRICS_PATH'), interval,
+                   bool(os.environ.get('TODO_COUNT_API_CALLS')))
+
+    def timed(self, name, function):
+        """
+        Returns function wrapped to record its latency and errors as the
+        operation name, or function itself when metrics are disabled
+        """
+        if not self.enabled:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            outer = getattr(self.local, 'operation', 'other')
+            self.local.operation = name
+            self.start_operation(name)
+            start = time.perf_counter()
+            failed = False
+            try:
+                return function(*args, **kwargs)
+            except self.ignored_errors:
+                raise
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self.local.operation = outer
+                self.record_operation(name, time.perf_counter() - start,
+                                      failed)
+        return wrapper
+
+    def instrument(self, cls):
+        """
+        Class decorator wrapping every public method defined in cls with
+        timed(), named ClassName.method
+        """
+        if not self.enabled:
+            return cls
+        for name, member in list(vars(cls).items()):
+            if (isinstance(member, types.FunctionType)
+                    and not name.startswith('_')):
+                setattr(cls, name,
+                        self.timed(f'{cls.__name__}.{name}', member))
+        return cls
+
+    def operation(self, name):
+        """
+        Returns the metrics of the operation name, created on first use.
+        Called while holding the lock.
+        """
+        operation = self.operations.get(name)
+        if operation is None:
+            operation = self.operations[name] = Operation()
+        return operation
+
+    def start_operation(self, name):
+        """
+        Start counting the API calls of a new run of the operation name
+        """
+        with self.lock:
+            self.operation(name).last_api_calls = 0
+
+    def record_operation(self, name, seconds, failed=False):
+        """
+        Record one run of the operation name
+        """
+        with self.lock:
+            operation = self.operation(name)
+            operation.latency.observe(seconds)
+            if failed:
+                operation.errors += 1
+
+    def record_api(self, method, seconds, cells_sent=0, cells_received=0):
+        """
+        Record one request of the gspread method, and count it for the
+        operation running in this thread
+        """
+        name = getattr(self.local, 'operation', 'other')
+        with self.lock:
+            api_method = self.api_methods.get(method)
+            if api_method is None:
+                api_method = self.api_methods[method] = ApiMethod()
+            api_method.latency.observe(seconds)
+            api_method.cells_sent += cells_sent
+            api_method.cells_received += cells_received
+            operation = self.operation(name)
+            operation.api_calls += 1
+            operation.last_api_calls += 1
+            operation.cells += cells_sent + cells_received
+
+    def api_call_summary(self):
+        """
+        Returns a printable summary of the API calls with one line per
+        operation which made any
+        """
+        lines = ['API calls per operation (latest run / total):']
+        with self.lock:
+            for name, operation in sorted(self.operations.items()):
+                if operation.api_calls:
+                    lines.append(f'{name}: {operation.last_api_calls} / '
+                                 f'{operation.api_calls}')
+        return '\n'.join(lines)
+
+    def to_json(self):
+        """
+        Returns the metrics as one line of JSON
+        """
+        with self.lock:
+            data = {
+                'time': datetime.now(timezone.utc).isoformat(
+                    timespec='seconds'),
+                'operations': {name: operation.to_dict() for name, operation
+                               in sorted(self.operations.items())},
+                'api': {method: api_method.to_dict() for method, api_method
+                        in sorted(self.api_methods.items())},
+            }
+        return json.dumps(data)
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text format
+        """
+        lines = []
+
+        def histogram(metric, label, histograms):
+            lines.append(f'# TYPE {metric} histogram')
+            for name, value in histograms:
+                for bound, count in value.cumulative():
+                    lines.append(f'{metric}_bucket{{{label}="{name}",'
+                                 f'le="{bound}"}} {count}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} '
+                             f'{value.total:.6f}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} '
+                             f'{value.count}')
+
+        def counter(metric, samples):
+            lines.append(f'# TYPE {metric} counter')
+            for labels, value in samples:
+                lines.append(f'{metric}{{{labels}}} {value}')
+
+        with self.lock:
+            operations = sorted(self.operations.items())
+            api_methods = sorted(self.api_methods.items())
+            histogram('todo_operation_seconds', 'operation',
+                      [(name, value.latency) for name, value in operations])
+            counter('todo_operation_errors_total',
+                    [(f'operation="{name}"', value.errors)
+                     for name, value in operations])
+            counter('todo_operation_api_calls_total',
+                    [(f'operation="{name}"', value.api_calls)
+                     for name, value in operations])
+            counter('todo_operation_cells_total',
+                    [(f'operation="{name}"', value.cells)
+                     for name, value in operations])
+            histogram('todo_api_request_seconds', 'method',
+                      [(name, value.latency) for name, value in api_methods])
+            counter('todo_api_cells_total',
+                    [(f'method="{name}",direction="{direction}"', cells)
+                     for name, value in api_methods
+                     for direction, cells in (('sent', value.cells_sent),
+                                              ('received',
+                                               value.cells_received))])
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        """
+        Write the metrics to the file: append a JSON line, or replace the
+        Prometheus text file in one step so it is never read half written
+        """
+        if self.output is None:
+            return
+        try:
+            if self.output == 'json':
+                with open(self.path, 'a', encoding='utf-8') as file:
+                    file.write(self.to_json() + '\n')
+            else:
+                temporary = f'{self.path}.tmp'
+                with open(temporary, 'w', encoding='utf-8') as file:
+                    file.write(self.to_prometheus())
+                os.replace(temporary, self.path)
+        except OSError as e:
+            print(f'Metrics could not be written to {self.path}: {e}')
+
+    def start(self):
+        """
+        Start exporting the metrics every interval seconds in a daemon
+        thread, when there is an output and the export is not running
+        """
+        if self.output is None or self.exporter is not None:
+            return
+
+        def export_periodically():
+            while not self.stopped.wait(self.interval):
+                self.export()
+
+        self.exporter = threading.Thread(target=export_periodically,
+                                         name='metrics-exporter',
+                                         daemon=True)
+        self.exporter.start()
+
+    def stop(self):
+        """
+        Stop the periodic export and export the metrics a last time, so the
+        two exports never write the file at the same time
+        """
+        self.stopped.set()
+        if self.exporter is not None:
+            self.exporter.join()
+            self.exporter = None
+        self.export()
+
+
+METRICS = Metrics.from_environment()
+if METRICS.output is not None:
+    # Registered before the app saves its changes at exit, so it runs after
+    # them and the final export includes their API calls
+    atexit.register(METRICS.stop)
+
+
+def count_cells(values):
+    """
+    Returns the number of cells in gspread values: a list of rows, a list
+    of ranges of rows as returned by batch_get, a batch of ranges with
+    values, or the response of a batch read. Only the innermost lists are
+    rows of cells, so a flat list at the top, such as a list of range
+    names, has none.
+    """
+    if isinstance(values, dict):
+        if 'valueRanges' in values:
+            return count_cells(values['valueRanges'])
+        return count_cells(values.get('values'))
+    if not isinstance(values, list):
+        return 0
+    cells = 0
+    for item in values:
+        if isinstance(item, dict):
+            cells += count_cells(item)
+        elif isinstance(item, list):
+            if any(isinstance(cell, (list, dict)) for cell in item):
+                cells += count_cells(item)
+            else:
+                cells += len(item)
+    return cells
@@ -3,23 +3,161 @@ This module contains the implementation of a to-do app. The user can create,
 open, delete and view to-do lists. Inside of every to-do list the user can add,
 update, sort, delete and view tasks.
 """
+import os
 import sys  # sys module to run the function sys.exit()
+import argparse
+import atexit
+import bisect
+import csv
+import functools
+import heapq
+import itertools
+import json
+import queue
+import re
+import shlex
+import signal
+import threading
+import time
 from datetime import datetime
-import gspread
-from google.oauth2.service_account import Credentials
+try:
+    # NumPy is optional and only used to speed up sorting of large lists
+    import numpy
+except ImportError:
+    numpy = None
+from metrics import METRICS
+from storage import (STAMP_INDEX, ListNotFound, StorageError, clean_row,
+                     open_storage, stamp_of)
 
-# Section of code taken from the Love Sandwich project
-SCOPE = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-    ]
+if os.environ.get('TODO_COUNT_API_CALLS'):
+    # Print the counts when the program exits
+    atexit.register(lambda: print(METRICS.api_call_summary()))
 
-CREDS = Credentials.from_service_account_file('creds.json')
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open('todo--app')
-# End of section code from the Love Sandwich project
+if METRICS.enabled:
+    # Time spent waiting for the user is recorded apart from the handlers
+    input = METRICS.timed('input', input)
+
+# Set TODO_STARTUP_TIMING to print the time from start to the first menu
+STARTUP_TIMING = {
+    'enabled': bool(os.environ.get('TODO_STARTUP_TIMING')),
+    # Only used when the start of the process cannot be read
+    'loaded': time.time(),
+}
+
+
+def process_start_time():
+    """
+    Returns the wall clock time when the process was started, read from
+    /proc on Linux or with psutil where it is installed, or None
+    """
+    try:
+        with open('/proc/self/stat', encoding='ascii') as file:
+            # The fields after the command name, which is in parentheses,
+            # start with field 3. Field 22 is the start time in clock ticks
+            # after boot.
+            fields = file.read().rpartition(')')[2].split()
+        with open('/proc/uptime', encoding='ascii') as file:
+            uptime = float(file.read().split()[0])
+        ticks = os.sysconf('SC_CLK_TCK')
+        return time.time() - uptime + int(fields[19]) / ticks
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().create_time()
+    except ImportError:
+        return None
+
+
+def report_startup_time():
+    """
+    Print the time it took from the start of the process, including
+    starting Python and importing the modules, until the first main menu
+    was shown, once, when startup timing is enabled
+    """
+    if STARTUP_TIMING['enabled']:
+        STARTUP_TIMING['enabled'] = False
+        started = process_start_time()
+        since = 'process start'
+        if started is None:
+            started = STARTUP_TIMING['loaded']
+            since = 'loading run.py'
+        elapsed = time.time() - started
+        print(f'Time to first menu since {since}: {elapsed * 1000:.1f} ms')
+
+
+DUE_DATE_FORMAT = '%d/%m/%y'
+
+
+class ReturnToMainMenu(Exception):
+    """
+    Raised when the user presses q, or an action cannot go on, to go back to
+    the main menu. The main loop catches it, so going back never nests
+    another loop.
+    """
+
+
+METRICS.ignored_errors = (ReturnToMainMenu,)
+
+
+@functools.lru_cache(maxsize=4096)
+def due_date_ordinal(due_date):
+    """
+    Returns the due date in the format dd/mm/yy as a day number, or None if
+    the due date is empty or invalid.
+    The results of the latest 4096 different due dates are cached, so every
+    unique due date is parsed once even when thousands of tasks are loaded
+    or imported, and tasks with the same due date share one day number.
+    Code from https://datatest.readthedocs.io/en/stable/how-to/date-time-
+    str.html and https://www.digitalocean.com/community/tutorials/python-
+    string-to-datetime-strptime
+    """
+    try:
+        # Try to parse the date using the specified format
+        return datetime.strptime(due_date, DUE_DATE_FORMAT).toordinal()
+    except (TypeError, ValueError):
+        # Date is not in the correct format
+        return None
+
+
+def validate_due_date(due_date):
+    """
+    Returns True if the due date is a valid date in the format dd/mm/yy,
+    otherwise returns False. No worksheet or handler is needed.
+    """
+    return due_date_ordinal(due_date) is not None
+
+
+def priority_number(priority):
+    """
+    Returns the priority as an integer. The default priority 10 is returned
+    if the priority is empty or not a number.
+    """
+    try:
+        return int(priority)
+    except (TypeError, ValueError):
+        return 10
+
+
+def task_error(task_name, due_date, priority):
+    """
+    Returns a message telling why a task with these fields can not be saved,
+    or None if it is valid. The task name is mandatory, the due date must be
+    empty or a date in the format dd/mm/yy and the priority empty or a number
+    between 1 and 10, the same rules as when a task is added in the app.
+    """
+    if not task_name:
+        return 'The task has no name'
+    if due_date and not validate_due_date(due_date):
+        return f'Invalid due date {due_date}'
+    if priority not in (None, ''):
+        try:
+            if 1 <= int(priority) <= 10:
+                return None
+        except ValueError:
+            pass
+        return f'Invalid priority {priority}'
+    return None
 
 
 class Task:
@@ -27,14 +165,49 @@ class Task:
     Class representing a task. Attributes are task_name, description, due_date
     and priority. Task name is mandatory for the user to enter, other
     attributes are optional. Default number 10 is set on priority if the user
-    does not enter a priority number.
+    does not enter a priority number. Row is the number of the task row in the
+    worksheet, counted from 0 at the first task row, or None while the task is
+    not yet written to the worksheet, and stored is the row as it was last
+    read from or written to the worksheet.
+    The fields are kept in slots instead of an instance dictionary to save
+    memory on large lists. The due date is parsed once, when it is set, into
+    the day number due_ordinal, and priority is always stored as an integer,
+    so sorting and filtering never parse them again.
     """
+    __slots__ = ('task_name', 'description', '_due_date', 'due_ordinal',
+                 '_priority', 'row', 'stored')
+
     def __init__(self, task_name, description=None, due_date=None,
-                 priority=10):
+                 priority=10, row=None):
         self.task_name = task_name
         self.description = description
         self.due_date = due_date
         self.priority = priority
+        self.row = row
+        self.stored = None
+
+    @property
+    def due_date(self):
+        """
+        The due date in the format dd/mm/yy
+        """
+        return self._due_date
+
+    @due_date.setter
+    def due_date(self, due_date):
+        self._due_date = due_date
+        self.due_ordinal = due_date_ordinal(due_date)
+
+    @property
+    def priority(self):
+        """
+        The priority number, where 1 is top priority
+        """
+        return self._priority
+
+    @priority.setter
+    def priority(self, priority):
+        self._priority = priority_number(priority)
 
     def task_summary(self):
         """
@@ -43,7 +216,1045 @@ class Task:
         return f'Task: {self.task_name}, Description: {self.description}, \
         Due Date: {self.due_date}, Priority: {self.priority}'
 
+    def to_row(self, todo_title):
+        """
+        Returns the worksheet row of the task in the to-do list todo_title
+        """
+        return [todo_title, self.task_name, self.description, self.due_date,
+                self.priority]
+
+
+# Sort key for tasks without a due date, which are sorted last
+NO_DUE_DATE = datetime.max.toordinal() + 1
+
+# The sort keys for every sorting choice in the sort menu
+SORT_CHOICES = {
+    '1': ('task_name',),
+    '2': ('due_date',),
+    '3': ('priority',),
+    '4': ('priority', 'due_date', 'task_name'),
+}
+
+
+def sort_key_column(tasks, key):
+    """
+    Returns the values of one sort key for all tasks: 'task_name' (ignoring
+    case), 'due_date' or 'priority'. The values come from the fields parsed
+    when the tasks were loaded.
+    """
+    if key == 'task_name':
+        return [task.task_name.casefold() for task in tasks]
+    if key == 'due_date':
+        return [NO_DUE_DATE if task.due_ordinal is None else task.due_ordinal
+                for task in tasks]
+    if key == 'priority':
+        return [task.priority for task in tasks]
+    raise ValueError(f'Unknown sort key: {key}')
+
+
+def sort_order(tasks, keys):
+    """
+    Returns the positions of tasks in sorted order, sorted on the first key
+    in keys, then on the second and so on. The sort is stable, so tasks with
+    equal keys keep their order. Every key is turned into one column of
+    values before sorting, and NumPy sorts the columns when it is installed.
+    """
+    columns = [sort_key_column(tasks, key) for key in keys]
+    if numpy is not None and tasks:
+        # lexsort sorts on the last column first
+        return numpy.lexsort([numpy.array(column) for column
+                              in reversed(columns)]).tolist()
+    # Stable sorts from the last key to the first give the same order
+    order = list(range(len(tasks)))
+    for column in reversed(columns):
+        order.sort(key=column.__getitem__)
+    return order
 
+
+def sort_tasks_by(tasks, keys):
+    """
+    Returns a new list with tasks sorted on keys
+    """
+    return [tasks[position] for position in sort_order(tasks, keys)]
+
+
+class TaskIndex:
+    """
+    Class with indexes over the tasks of a to-do list, so tasks can be found
+    without looking through the whole list:
+    - by name, case-insensitive, in a dictionary
+    - by priority, in a dictionary
+    - by due date, in a list sorted on the day number of the due date
+    - by priority and due date, in a heap giving the next tasks to do
+    The index must be told about every added, removed and edited task.
+    Removed and edited tasks leave their old entry in the heap, which is
+    skipped when it is reached and dropped when the heap is compacted.
+    """
+    def __init__(self, tasks=()):
+        self.by_name = {}
+        self.by_priority = {}
+        self.by_due_date = []
+        self.queue = []
+        # The indexed keys of every task, used to remove the old entries when
+        # a task is edited
+        self.keys = {}
+        self.serials = itertools.count()
+        for task in tasks:
+            self.add(task)
+
+    def add(self, task):
+        """
+        Add a task to the indexes
+        """
+        name = task.task_name.casefold()
+        priority = task.priority
+        due_key = (task.due_ordinal, next(self.serials))
+        self.keys[task] = (name, priority, due_key)
+        self.by_name.setdefault(name, []).append(task)
+        self.by_priority.setdefault(priority, []).append(task)
+        if due_key[0] is not None:
+            # The due keys are unique, so the tasks are never compared
+            bisect.insort(self.by_due_date, (due_key, task))
+        due_ordinal = NO_DUE_DATE if due_key[0] is None else due_key[0]
+        heapq.heappush(self.queue, (priority, due_ordinal, due_key[1], task))
+        if len(self.queue) > 2 * len(self.keys) + 16:
+            self.compact_queue()
+
+    def compact_queue(self):
+        """
+        Drop the old entries of removed and edited tasks from the heap
+        """
+        self.queue = [entry for entry in self.queue if self.is_current(entry)]
+        heapq.heapify(self.queue)
+
+    def is_current(self, entry):
+        """
+        Returns True if a heap entry belongs to the task as it is now
+        """
+        keys = self.keys.get(entry[3])
+        return keys is not None and keys[2][1] == entry[2]
+
+    def remove(self, task):
+        """
+        Remove a task from the indexes
+        """
+        name, priority, due_key = self.keys.pop(task)
+        self.remove_from(self.by_name, name, task)
+        self.remove_from(self.by_priority, priority, task)
+        if due_key[0] is not None:
+            # (due_key,) sorts right before the entry of the task
+            position = bisect.bisect_left(self.by_due_date, (due_key,))
+            del self.by_due_date[position]
+
+    def remove_from(self, index, key, task):
+        """
+        Remove a task from the list of key in a dictionary index
+        """
+        tasks = index[key]
+        tasks.remove(task)
+        if not tasks:
+            del index[key]
+
+    def update(self, task):
+        """
+        Move an edited task to the entries of its new values. A task which
+        is not indexed, because it has been removed, is left out.
+        """
+        if task in self.keys:
+            self.remove(task)
+            self.add(task)
+
+    def contains(self, task):
+        """
+        Returns True if the task is indexed
+        """
+        return task in self.keys
+
+    def find_by_name(self, task_name):
+        """
+        Returns the first task called task_name, ignoring case, or None
+        """
+        tasks = self.by_name.get(task_name.casefold())
+        return tasks[0] if tasks else None
+
+    def with_priority(self, priority):
+        """
+        Returns the tasks with the given priority number
+        """
+        return list(self.by_priority.get(priority, []))
+
+    def due_between(self, first, last):
+        """
+        Returns the tasks due from day number first to day number last,
+        ordered by due date
+        """
+        # A due key (day number,) sorts before every entry of that day
+        start = bisect.bisect_left(self.by_due_date, ((first,),))
+        stop = bisect.bisect_left(self.by_due_date, ((last + 1,),))
+        return [task for _, task in self.by_due_date[start:stop]]
+
+    def next_tasks(self, count):
+        """
+        Returns the count tasks to do next: the tasks with the top priority
+        and, among equal priorities, the earliest due date. The entries are
+        taken from the heap and pushed back, so this costs count log n steps.
+        """
+        taken = []
+        while self.queue and len(taken) < count:
+            entry = heapq.heappop(self.queue)
+            if self.is_current(entry):
+                taken.append(entry)
+        for entry in taken:
+            heapq.heappush(self.queue, entry)
+        return [entry[3] for entry in taken]
+
+
+def search_tokens(text):
+    """
+    Returns the set of lower case words in text, the tokens of the search
+    index
+    """
+    return set(re.findall(r'\w+', text.casefold())) if text else set()
+
+
+def parse_priority_range(text):
+    """
+    Returns the (lowest, highest) priority numbers of a priority range
+    written as 'N' or 'N-M'. An empty text is the whole range 1-10. Raises
+    ValueError if the range is invalid.
+    """
+    if not text:
+        return 1, 10
+    first, _, last = text.partition('-')
+    try:
+        low, high = int(first), int(last or first)
+    except ValueError:
+        raise ValueError(f'Invalid priority range {text}') from None
+    if not 1 <= low <= high <= 10:
+        raise ValueError(f'Invalid priority range {text}')
+    return low, high
+
+
+def parse_due_date(text):
+    """
+    Returns the day number of a due date in the format dd/mm/yy, or None
+    for an empty text. Raises ValueError if the date is invalid.
+    """
+    if not text:
+        return None
+    ordinal = due_date_ordinal(text)
+    if ordinal is None:
+        raise ValueError(f'Invalid date {text}')
+    return ordinal
+
+
+class SearchIndex:
+    """
+    Class with an inverted index over the tasks of all to-do lists. Every
+    word of the task name and description points to the set of tasks
+    containing it, so a search intersects a few sets instead of looking
+    through every task. The tasks are also kept by priority, and matches are
+    filtered on a priority range and a due date window.
+    The index is built the first time it is searched. After that the task
+    caches tell it about every loaded, added, edited and removed task, so it
+    stays up to date without being rebuilt.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.by_token = {}
+        self.by_priority = {}
+        # The list name and indexed keys of every task, and the tasks of
+        # every list
+        self.entries = {}
+        self.lists = {}
+        self.lock = threading.RLock()
+
+    def build(self, tasks_by_list):
+        """
+        Index the tasks of every list in the dictionary tasks_by_list and
+        start following the changes of the task caches
+        """
+        with self.lock:
+            for list_name, tasks in tasks_by_list.items():
+                self.replace_list(list_name, tasks, force=True)
+            self.enabled = True
+
+    def refresh(self, storage):
+        """
+        Load the to-do lists of the storage which are not loaded yet, which
+        adds them to the index, and build the index on first use
+        """
+        tasks_by_list = TaskCache.load_all(storage)
+        if not self.enabled:
+            self.build(tasks_by_list)
+
+    def add(self, list_name, task):
+        """
+        Add a task of the list list_name to the index
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.add_entry(list_name, task)
+
+    def add_entry(self, list_name, task):
+        """
+        Add the entries of a task to the index
+        """
+        tokens = search_tokens(task.task_name) | \
+            search_tokens(task.description)
+        priority = task.priority
+        self.entries[task] = (list_name, tokens, priority)
+        self.lists.setdefault(list_name, set()).add(task)
+        for token in tokens:
+            self.by_token.setdefault(token, set()).add(task)
+        self.by_priority.setdefault(priority, set()).add(task)
+
+    def remove(self, task):
+        """
+        Remove a task from the index
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.remove_entry(task)
+
+    def remove_entry(self, task):
+        """
+        Remove the entries of a task from the index, if it has any
+        """
+        entry = self.entries.pop(task, None)
+        if entry is None:
+            return
+        list_name, tokens, priority = entry
+        self.lists[list_name].discard(task)
+        for token in tokens:
+            self.discard(self.by_token, token, task)
+        self.discard(self.by_priority, priority, task)
+
+    @staticmethod
+    def discard(index, key, task):
+        """
+        Remove a task from the set of key in a dictionary index
+        """
+        tasks = index[key]
+        tasks.discard(task)
+        if not tasks:
+            del index[key]
+
+    def update(self, task):
+        """
+        Move an edited task to the entries of its new values
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.entries.get(task)
+            if entry is not None:
+                self.remove_entry(task)
+                self.add_entry(entry[0], task)
+
+    def replace_list(self, list_name, tasks, force=False):
+        """
+        Replace the indexed tasks of a list, after it has been loaded
+        """
+        if not (self.enabled or force):
+            return
+        with self.lock:
+            self.remove_list(list_name, force)
+            for task in tasks:
+                self.add_entry(list_name, task)
+
+    def remove_list(self, list_name, force=False):
+        """
+        Remove the tasks of a list from the index
+        """
+        if not (self.enabled or force):
+            return
+        with self.lock:
+            for task in list(self.lists.get(list_name, ())):
+                self.remove_entry(task)
+            self.lists.pop(list_name, None)
+
+    def search(self, text='', priorities=(1, 10), due_dates=(None, None)):
+        """
+        Returns (list name, task) tuples for the tasks containing every word
+        of text, with a priority in the range priorities and, if either end
+        of due_dates is given, a due date in that window. The ends of the
+        window are day numbers and may be None. The tasks are ordered by
+        priority, then due date, then task name.
+        """
+        low, high = priorities
+        first, last = due_dates
+        with self.lock:
+            # Start from the smallest set and keep the tasks in all others
+            candidates = [self.by_token.get(token, set())
+                          for token in search_tokens(text)]
+            candidates.sort(key=len)
+            if candidates:
+                matches = set(candidates[0]).intersection(*candidates[1:])
+                if (low, high) != (1, 10):
+                    matches = {task for task in matches
+                               if low <= self.entries[task][2] <= high}
+            else:
+                matches = set().union(
+                    *(self.by_priority.get(priority, ())
+                      for priority in range(low, high + 1)))
+            if first is not None or last is not None:
+                matches = {task for task in matches
+                           if task.due_ordinal is not None
+                           and (first is None or task.due_ordinal >= first)
+                           and (last is None or task.due_ordinal <= last)}
+            list_names = {task: self.entries[task][0] for task in matches}
+        tasks = sort_tasks_by(list(list_names), SORT_CHOICES['4'])
+        return [(list_names[task], task) for task in tasks]
+
+
+SEARCH_INDEX = SearchIndex()
+
+
+def parse_flush_policy(policy):
+    """
+    Parse a flush policy: 'immediate', 'background', 'exit' or 'interval:N'
+    where N is a number of seconds. Returns a tuple with the policy name and
+    the interval.
+    """
+    name, _, seconds = policy.partition(':')
+    if name in ('immediate', 'background', 'exit') and not seconds:
+        return name, None
+    if name == 'interval':
+        try:
+            if float(seconds) > 0:
+                return name, float(seconds)
+        except ValueError:
+            pass
+    print(f'Invalid flush policy {policy}. Changes are saved immediately.')
+    return 'immediate', None
+
+
+def stored_row_keys(row):
+    """
+    Returns the keys a task row is found by among the rows of a worksheet
+    changed by others, from the most to the least exact: its row stamp, or
+    None if it has none, its cells and its task name
+    """
+    cells = clean_row(row)[:STAMP_INDEX]
+    cells += [''] * (STAMP_INDEX - len(cells))
+    stamp = stamp_of(row)
+    return (('stamp', stamp) if stamp else None, ('cells', tuple(cells)),
+            ('name', cells[1].casefold()))
+
+
+# Seconds between checks for changes made to a loaded worksheet by others
+CHANGE_CHECK_INTERVAL = float(os.environ.get('TODO_CHANGE_CHECK_INTERVAL',
+                                             10))
+FLUSH_POLICY = parse_flush_policy(os.environ.get('TODO_FLUSH_POLICY',
+                                                 'immediate'))
+
+
+class TaskCache:
+    """
+    Class keeping the tasks of one to-do list in memory. The tasks are loaded
+    once and read from memory after that. Changed tasks are marked dirty and
+    only those rows are written back when the cache is flushed. Every task
+    knows its row in the worksheet, so an edit rewrites only that row and a
+    delete removes only that row. Before rows are written by their numbers
+    the worksheet is checked for rows moved by others, and if it has any
+    the changes are merged into the rows read again. When the cache is
+    flushed depends on the flush policy:
+    - immediate: after every change
+    - background: after every change, by the background writer thread
+    - exit: when the user goes back to the main menu or quits the app
+    - interval:N: N seconds after the first change that is not yet written
+    The policy is set with the TODO_FLUSH_POLICY environment variable.
+    Changes made to the worksheet by others are picked up by refresh, at
+    most every check_interval seconds.
+    """
+    caches = {}
+    # Held while looking up or dropping caches, which threads share
+    caches_lock = threading.Lock()
+    # The policy of new caches, changed by the command line commands
+    default_policy = FLUSH_POLICY
+    check_interval = CHANGE_CHECK_INTERVAL
+
+    def __init__(self, worksheet, policy=None):
+        self.worksheet = worksheet
+        self.policy, self.interval = policy or TaskCache.default_policy
+        self.tasks = None
+        self.index = TaskIndex()
+        # Changed tasks already in the worksheet, and tasks not yet appended
+        self.dirty = set()
+        self.new_tasks = []
+        # Removed tasks whose rows are not yet deleted from the worksheet
+        self.deleted_tasks = []
+        # Set when the tasks are reordered, so all rows are rewritten
+        self.rewrite = False
+        self.timer = None
+        self.lock = threading.RLock()
+        # Held while writing, so flushes from different threads run in order
+        self.write_lock = threading.Lock()
+        # Counts the changes to the tasks, so views of them know when they
+        # are out of date
+        self.version = 0
+        # When the worksheet was last read or checked for changes
+        self.checked_at = 0
+
+    @classmethod
+    def for_worksheet(cls, worksheet):
+        """
+        Returns the cache of the worksheet, created on first use
+        """
+        with cls.caches_lock:
+            cache = cls.caches.get(worksheet.title)
+            if cache is None:
+                cache = cls(worksheet)
+                cls.caches[worksheet.title] = cache
+            return cache
+
+    @classmethod
+    def drop(cls, title):
+        """
+        Forget the cache of a deleted worksheet without writing it
+        """
+        with cls.caches_lock:
+            cache = cls.caches.pop(title, None)
+        if cache and cache.timer:
+            cache.timer.cancel()
+        SEARCH_INDEX.remove_list(title)
+
+    @classmethod
+    def flush_all(cls, policy=None):
+        """
+        Write the changes of all caches to their worksheets, or only of the
+        caches with the flush policy policy
+        """
+        for cache in list(cls.caches.values()):
+            if policy is not None and cache.policy != policy:
+                continue
+            try:
+                cache.flush()
+            except StorageError as e:
+                print(f'{e} error saving {cache.worksheet.title}')
+
+    def get_tasks(self):
+        """
+        Returns the tasks of the worksheet, loading them on first use
+        """
+        with self.lock:
+            if self.tasks is None:
+                self.load()
+            return self.tasks
+
+    def reload(self):
+        """
+        Load the tasks from the worksheet again. Pending changes are written
+        first so they are not lost.
+        """
+        # Not flushed under the lock, which the writer thread needs
+        self.flush()
+        with self.lock:
+            self.load()
+
+    def load(self):
+        """
+        Read the tasks from the worksheet and index them. Tasks which are
+        already loaded keep their Task objects, as sessions sharing the
+        cache may be editing them.
+        """
+        with self.lock:
+            rows = self.worksheet.load_rows()
+            if self.tasks is None:
+                self.set_rows(rows)
+            else:
+                self.merge_rows(rows)
+            self.checked_at = time.monotonic()
+
+    def refresh(self):
+        """
+        Returns the tasks, first loading them, or bringing them up to date
+        with changes made to the worksheet by other users if it was not
+        checked in the last check_interval seconds. An unchanged worksheet
+        costs one small read. The changes are merged into the loaded tasks,
+        so a task which another session sharing the cache is editing keeps
+        its Task object unless it has been deleted. The check is skipped
+        while changes are not yet written.
+        """
+        with self.lock:
+            if self.tasks is None:
+                self.load()
+            elif (time.monotonic() - self.checked_at >= self.check_interval
+                  and not self.is_dirty() and not self.write_lock.locked()):
+                rows = self.worksheet.load_changed_rows()
+                self.checked_at = time.monotonic()
+                if rows is not None:
+                    self.merge_rows(rows)
+            return self.tasks
+
+    def set_rows(self, rows):
+        """
+        Make the tasks of the rows, read from the worksheet, the loaded tasks
+        """
+        with self.lock:
+            self.tasks = [Task(row[1], row[2], row[3], row[4], number)
+                          for number, row in enumerate(rows)]
+            for task, row in zip(self.tasks, rows):
+                task.stored = row
+            self.index = TaskIndex(self.tasks)
+            self.version += 1
+            SEARCH_INDEX.replace_list(self.worksheet.title, self.tasks)
+
+    @classmethod
+    def load_all(cls, storage):
+        """
+        Returns a dictionary from the name of every to-do list in the storage
+        to its tasks. The lists which are not loaded yet are read together
+        with storage.load_lists, in one round-trip where the storage
+        supports it, and kept in their caches for later use.
+        """
+        names = storage.list_names()
+        missing = [name for name in names
+                   if name not in cls.caches or cls.caches[name].tasks is None]
+        for name, rows in storage.load_lists(missing).items():
+            cache = cls.for_worksheet(storage.open_list(name))
+            with cache.lock:
+                # The list may have been loaded meanwhile
+                if cache.tasks is None:
+                    cache.set_rows(rows)
+                    cache.worksheet.remember_rows(rows)
+                    cache.checked_at = time.monotonic()
+        return {name: cls.for_worksheet(storage.open_list(name)).get_tasks()
+                for name in names}
+
+    def add(self, task):
+        """
+        Add a new task to the end of the to-do list
+        """
+        with self.lock:
+            self.get_tasks().append(task)
+            self.index.add(task)
+            SEARCH_INDEX.add(self.worksheet.title, task)
+            self.new_tasks.append(task)
+            self.version += 1
+        self.changed()
+
+    def mark_dirty(self, task):
+        """
+        Mark a task which has been edited in memory as changed. Returns
+        False, and changes nothing, if the task is no longer in the list,
+        as another session may have deleted it while it was edited.
+        """
+        with self.lock:
+            if not self.index.contains(task):
+                return False
+            self.index.update(task)
+            SEARCH_INDEX.update(task)
+            if task not in self.new_tasks:
+                self.dirty.add(task)
+            self.version += 1
+        self.changed()
+        return True
+
+    def due_between(self, first, last):
+        """
+        Returns the tasks due from day number first to day number last,
+        ordered by due date
+        """
+        with self.lock:
+            self.get_tasks()
+            return self.index.due_between(first, last)
+
+    def next_tasks(self, count):
+        """
+        Returns the count tasks with the top priority and earliest due date
+        """
+        with self.lock:
+            self.get_tasks()
+            return self.index.next_tasks(count)
+
+    def reindex(self, task):
+        """
+        Update the indexes after a task has been edited in memory. A task
+        which is no longer in the list is left out.
+        """
+        with self.lock:
+            if not self.index.contains(task):
+                return
+            self.index.update(task)
+            self.version += 1
+            SEARCH_INDEX.update(task)
+
+    def find_by_name(self, task_name):
+        """
+        Returns the first task called task_name, ignoring case, or None
+        """
+        with self.lock:
+            self.get_tasks()
+            return self.index.find_by_name(task_name)
+
+    def remove(self, task):
+        """
+        Remove a task from the to-do list
+        """
+        with self.lock:
+            self.get_tasks().remove(task)
+            self.index.remove(task)
+            SEARCH_INDEX.remove(task)
+            self.dirty.discard(task)
+            if task in self.new_tasks:
+                self.new_tasks.remove(task)
+            elif self.rewrite or task.row is None:
+                task.row = None
+            else:
+                # The task keeps its row number until the row is deleted
+                self.deleted_tasks.append(task)
+            self.version += 1
+        self.changed()
+
+    def reorder(self, tasks):
+        """
+        Replace the order of the tasks with the order in tasks
+        """
+        with self.lock:
+            self.get_tasks()[:] = tasks
+            self.rewrite = True
+            self.version += 1
+        self.changed()
+
+    def unload(self):
+        """
+        Write the pending changes and forget the loaded tasks, so they are
+        read from the worksheet again on next use. Used after rows have been
+        written to the worksheet without going through the cache.
+        """
+        self.flush()
+        with self.lock:
+            self.tasks = None
+            self.index = TaskIndex()
+            self.version += 1
+            SEARCH_INDEX.remove_list(self.worksheet.title)
+
+    def start_empty(self):
+        """
+        Mark the cache as loaded with no tasks, for a new worksheet
+        """
+        with self.lock:
+            self.tasks = []
+            self.index = TaskIndex()
+            self.version += 1
+            SEARCH_INDEX.replace_list(self.worksheet.title, [])
+
+    def is_dirty(self):
+        """
+        Returns True if there are changes not yet written
+        """
+        return bool(self.rewrite or self.dirty or self.new_tasks
+                    or self.deleted_tasks)
+
+    def changed(self):
+        """
+        Apply the flush policy after a change. Called after the lock is
+        released: flush takes the write lock and then the lock, and taking
+        them in the other order would deadlock with a flush running in
+        another thread.
+        """
+        if self.policy == 'immediate':
+            self.flush()
+        elif self.policy == 'background':
+            WRITER.submit(self)
+        elif self.policy == 'interval':
+            with self.lock:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.interval,
+                                                 self.flush_in_timer)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+    def flush_in_timer(self):
+        """
+        Flush the cache from the interval timer thread
+        """
+        try:
+            self.flush()
+        except StorageError as e:
+            print(f'{e} error saving {self.worksheet.title}')
+
+    def flush(self):
+        """
+        Write the changes to the worksheet. A reordered list is rewritten in
+        one batch. Otherwise the deleted rows are removed, the changed rows
+        are updated and the new tasks appended, so the cost of a flush
+        depends on the number of changes and not on the size of the list.
+        The writes are collected while holding the lock and made after it
+        is released, so the tasks can be changed in memory while a flush
+        is waiting for the storage. The rows to update and delete are
+        checked first, and if others have moved them the worksheet is read
+        again and the changes merged into it, so no other row is written.
+        If writing fails the whole list is rewritten on the next flush and
+        the StorageError is raised.
+        """
+        with self.write_lock:
+            with self.lock:
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.is_dirty():
+                    return
+                numbers = [] if self.rewrite else [
+                    task.row for task in itertools.chain(self.deleted_tasks,
+                                                         self.dirty)
+                    if task.row is not None]
+            if numbers and not self.worksheet.check_rows(numbers):
+                rows = self.worksheet.load_rows()
+                with self.lock:
+                    self.merge_rows(rows)
+                    self.checked_at = time.monotonic()
+            with self.lock:
+                writes = self.take_writes()
+            try:
+                for write, argument in writes:
+                    write(argument)
+                self.worksheet.finish_writes()
+            except Exception:
+                with self.lock:
+                    # Some of the writes may have been made, so it is not
+                    # known which rows the worksheet has
+                    self.rewrite = True
+                raise
+
+    def take_writes(self):
+        """
+        Returns the writes which bring the worksheet up to date as a list of
+        (method, argument) tuples and clears the pending changes. The rows of
+        the tasks are set to the rows they have after the writes.
+        """
+        title = self.worksheet.title
+        writes = []
+        if self.rewrite:
+            rows = [task.to_row(title) for task in self.tasks]
+            writes.append((self.worksheet.replace_rows, rows))
+            for number, (task, row) in enumerate(zip(self.tasks, rows)):
+                task.row = number
+                task.stored = row
+            # All changes are part of the rewritten rows
+            for task in self.deleted_tasks:
+                task.row = None
+            self.deleted_tasks.clear()
+            self.dirty.clear()
+            self.new_tasks.clear()
+            self.rewrite = False
+        if self.deleted_tasks:
+            # Deleted from the bottom up, so the rows above keep their
+            # numbers
+            for task in sorted(self.deleted_tasks, key=lambda task: task.row,
+                               reverse=True):
+                writes.append((self.delete_row, task.row))
+                task.row = None
+            self.deleted_tasks.clear()
+            # The tasks in the worksheet are in worksheet order, followed by
+            # the new tasks
+            for number, task in enumerate(self.tasks):
+                if task.row is not None:
+                    task.row = number
+        if self.new_tasks:
+            rows = [task.to_row(title) for task in self.new_tasks]
+            writes.append((self.worksheet.append_rows, rows))
+            # New tasks are always at the end of the list
+            first_row = len(self.tasks) - len(self.new_tasks)
+            for number, (task, row) in enumerate(zip(self.new_tasks, rows)):
+                task.row = first_row + number
+                task.stored = row
+            self.new_tasks.clear()
+        # Updated last, as the worksheet stamp can be sent with the rows
+        if self.dirty:
+            rows = {}
+            for task in self.dirty:
+                task.stored = rows[task.row] = task.to_row(title)
+            writes.append((self.worksheet.update_rows, rows))
+            self.dirty.clear()
+        return writes
+
+    def merge_rows(self, rows):
+        """
+        Make the tasks of the rows, read from the worksheet after others
+        changed it, the loaded tasks, keeping the changes not yet written.
+        Every task in the worksheet is found among the rows by the row it
+        was stored as: by its row stamp, else by its cells, else by its task
+        name, as others may have edited it. Tasks which are not found have
+        been deleted by others, and rows where no task is found have been
+        added by others.
+        """
+        with self.lock:
+            # The row numbers of every key, from the last to the first, so
+            # the first row not yet taken is at the end
+            free = {}
+            for number in range(len(rows) - 1, -1, -1):
+                for key in stored_row_keys(rows[number]):
+                    if key is not None:
+                        free.setdefault(key, []).append(number)
+            stored = [task for task in self.tasks if task.row is not None]
+            stored += self.deleted_tasks
+            found = {}
+            matched = set()
+            for kind in range(3):
+                for task in stored:
+                    if task in matched:
+                        continue
+                    numbers = free.get(stored_row_keys(task.stored)[kind])
+                    while numbers and numbers[-1] in found:
+                        numbers.pop()
+                    if numbers:
+                        found[numbers.pop()] = task
+                        matched.add(task)
+            for task in stored:
+                # Set again below for the tasks which are found
+                task.row = None
+            deleted = set(self.deleted_tasks)
+            tasks = []
+            self.deleted_tasks = []
+            for number, row in enumerate(rows):
+                task = found.get(number)
+                if task is None:
+                    task = Task(row[1], row[2], row[3], row[4])
+                elif (task not in self.dirty and stored_row_keys(row)[1]
+                      != stored_row_keys(task.stored)[1]):
+                    # Edited by others
+                    task.task_name, task.description, task.due_date, \
+                        task.priority = row[1:STAMP_INDEX]
+                task.row = number
+                task.stored = row
+                if task in deleted:
+                    self.deleted_tasks.append(task)
+                else:
+                    tasks.append(task)
+            self.dirty &= matched
+            self.tasks = tasks + self.new_tasks
+            self.index = TaskIndex(self.tasks)
+            self.version += 1
+            SEARCH_INDEX.replace_list(self.worksheet.title, self.tasks)
+
+    def delete_row(self, row):
+        """
+        Delete one row from the worksheet
+        """
+        self.worksheet.delete_rows(row, row + 1)
+
+
+class BackgroundWriter:
+    """
+    Class flushing task caches on a worker thread, used by the background
+    flush policy. The changes are already made in memory when a cache is
+    submitted, so the user gets the menu back without waiting for the
+    storage. A cache is queued at most once until the worker takes it, so
+    a burst of changes is written in one batch, and the queue never holds
+    more caches than there are to-do lists, and submit never waits. A
+    failed flush is retried with a growing delay, whatever the error, so the
+    worker thread keeps running. The queue is drained when the program
+    exits, waiting for at most exit_timeout seconds.
+    """
+    def __init__(self, retries=3, retry_delay=0.5, exit_timeout=30):
+        self.queue = queue.Queue()
+        # The caches in the queue which the worker has not yet taken
+        self.pending = set()
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.exit_timeout = exit_timeout
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, cache):
+        """
+        Queue a flush of the cache unless one is already queued, starting
+        the worker thread on first use
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if cache in self.pending:
+                return
+            self.pending.add(cache)
+        self.queue.put(cache)
+
+    def run(self):
+        """
+        Take caches from the queue and flush them until None is taken
+        """
+        running = True
+        while running:
+            caches = [self.queue.get()]
+            # Take everything queued meanwhile, to flush every cache once
+            while True:
+                try:
+                    caches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            running = None not in caches
+            with self.lock:
+                # Changes made from now on queue the cache again
+                self.pending.difference_update(caches)
+            try:
+                for cache in caches:
+                    if cache is not None:
+                        self.flush(cache)
+            finally:
+                for _ in caches:
+                    self.queue.task_done()
+
+    def flush(self, cache):
+        """
+        Flush the cache, retrying when it fails, also with errors which are
+        not storage errors, such as a lost connection. If every try fails
+        the changes stay in the cache and are written by the next flush.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                cache.flush()
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    print(f'{e} error saving {cache.worksheet.title}. '
+                          'The changes are saved with the next change.')
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def drain(self, timeout=None):
+        """
+        Wait until every queued cache has been flushed, for at most timeout
+        seconds if timeout is given. Returns True if the queue is drained.
+        """
+        if self.thread is None:
+            return True
+        # Queue.join cannot time out, so it waits in a thread of its own
+        waiter = threading.Thread(target=self.queue.join, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        return not waiter.is_alive()
+
+    def close(self):
+        """
+        Drain the queue and stop the worker thread, waiting for at most
+        exit_timeout seconds
+        """
+        if self.thread is not None:
+            if self.drain(self.exit_timeout):
+                self.queue.put(None)
+                self.thread.join(self.exit_timeout)
+            else:
+                print('Saving the changes in the background took too long. '
+                      'Changes not saved yet are saved now.')
+            self.thread = None
+
+
+WRITER = BackgroundWriter()
+
+
+# Write pending changes when the program exits. The functions run in reverse
+# order, so the background writer is drained before the last flush.
+atexit.register(TaskCache.flush_all)
+atexit.register(WRITER.close)
+
+
+@METRICS.instrument
 class TaskHandler:
     """
     Class for handling tasks by using a worksheet and the class for
@@ -53,24 +1264,52 @@ class TaskHandler:
         self.worksheet_handler = worksheet_handler
         self.user_input_handler = user_input_handler
         self.worksheet = worksheet
+        self.cache = None
+        # The sort keys of the sorted view, and the view as a tuple of the
+        # cache version it was made from and the tasks in view order
+        self.view_keys = None
+        self.view = None
         if self.worksheet:
             # When worksheet is provided the load_tasks method loads all tasks
             # in that worksheet
+            self.cache = TaskCache.for_worksheet(worksheet)
             self.load_tasks()
 
-    def load_tasks(self):
+    @property
+    def tasks(self):
         """
-        Method loads tasks from the worksheet and creates Task instances for
-        each row and append to tasks list
+        The tasks of the worksheet, read from the task cache
         """
-        if self.worksheet:
-            data = self.worksheet.get_all_values()
-            # Initialize an empty list
-            self.tasks = []
-            # Skip the first row witch is the header row
-            for row in data[1:]:
-                task = Task(row[1], row[2], row[3], row[4])
-                self.tasks.append(task)
+        return self.cache.get_tasks() if self.cache else []
+
+    def sorted_view(self):
+        """
+        Returns the tasks in the order of the sorted view chosen in
+        sort_tasks, or in worksheet order if no view is chosen. The order is
+        kept until the tasks change, so it is only sorted again after a
+        change.
+        """
+        tasks = self.tasks
+        if self.view_keys is None:
+            return tasks
+        version = self.cache.version
+        if self.view is None or self.view[0] != version:
+            self.view = (version, sort_tasks_by(tasks, self.view_keys))
+        return self.view[1]
+
+    def load_tasks(self, force=False):
+        """
+        Method loads tasks from the worksheet and creates Task instances for
+        each row. All rows are fetched from the worksheet the first time, or
+        when force is True. Otherwise the tasks are read from the cache,
+        which checks the worksheet for changes made by others and reads
+        only the new and changed rows.
+        """
+        if self.cache:
+            if force:
+                self.cache.reload()
+            else:
+                self.cache.refresh()
 
     def display_all_tasks(self):
         """
@@ -83,51 +1322,36 @@ class TaskHandler:
             print('No tasks available.')
             print()
             print('Going back to the main menu')
-            self.worksheet_handler.start_worksheet_loop()
+            raise ReturnToMainMenu
         # Loop to get the task with all the information about every task
-        for task in self.tasks:
+        view = self.sorted_view()
+        for task in view:
             print(f'{task.task_summary()}')
-        return self.tasks
+        return view
 
     def validate_due_date_input(self, due_date):
         """
         Method to validate due date format. Returns True if the format is
         correct, otherwise returns False.
-        Code from https://datatest.readthedocs.io/en/stable/how-to/date-time-
-        str.html and https://www.digitalocean.com/community/tutorials/python-
-        string-to-datetime-strptime
         """
-        try:
-            # Try to parse the date using the specified format
-            datetime.strptime(due_date, '%d/%m/%y')
-            # Date is in the correct format
-            return True
-        except ValueError:
-            # Date is not in the correct format
-            return False
+        return validate_due_date(due_date)
 
     def add_task(self, task_data, worksheet_name=None, worksheet=None):
         """
         Add a task to a opened worksheet.
-        The method calls the update_worksheet_data method.
+        The task is added to the task cache, which writes it to the worksheet.
         """
         try:
             if worksheet_name and worksheet:
-                row_data = [worksheet_name] + task_data
-                # List comprehension to replace any None in row_data with an
-                # empty string
-                row_data = [item if item is not None else '' for item
-                            in row_data]
-                worksheet.append_row(row_data)
+                self.save_changes(TaskCache.for_worksheet(worksheet).add,
+                                  Task(*task_data))
                 print(f'Task added to {worksheet_name}')
-                self.load_tasks()
             else:
                 print('Invalid worksheet information. Task was not added.')
-        except gspread.exceptions.APIError as e:
+        except StorageError as e:
             print(f'{e} error adding task')
         print()
         print('Going back to the main menu')
-        self.worksheet_handler.start_worksheet_loop()
 
     def update_task(self, task_name):
         """
@@ -136,28 +1360,35 @@ class TaskHandler:
         The method displays the current information for the user and let the
         user update information in the categories they want to update. If the
         user do not want to update a specific category, the user press Enter
-        to go to the next category.
+        to go to the next category. If the user presses q, the categories
+        updated so far are saved.
         """
         task_to_update = self.find_task_by_name(task_name)
 
         if task_to_update:
-            self.update_task_name(task_to_update)
-            self.update_description(task_to_update)
-            self.update_due_date(task_to_update)
-            self.update_priority(task_to_update)
-            print(f'Task {task_to_update.task_name} updated sucessfully')
-            self.update_worksheet_data()
+            try:
+                self.update_task_name(task_to_update)
+                self.update_description(task_to_update)
+                self.update_due_date(task_to_update)
+                self.update_priority(task_to_update)
+            finally:
+                saved = self.save_changes(self.cache.mark_dirty,
+                                          task_to_update)
+            if saved is False:
+                print(f'Task {task_name} was deleted while it was updated. '
+                      'The changes are not saved.')
+            else:
+                print(f'Task {task_to_update.task_name} updated sucessfully')
         else:
             print(f'Task {task_name} not found.')
-        if self.worksheet_handler:
-            self.worksheet_handler.start_worksheet_loop()
 
     def find_task_by_name(self, task_name):
         """
         Method to find a task in the worksheet by its name.
         """
-        return next((task for task in self.tasks if task.task_name.lower()
-                    == task_name.lower()), None)
+        if not self.cache:
+            return None
+        return self.cache.find_by_name(task_name)
 
     def update_task_name(self, task):
         """
@@ -169,6 +1400,7 @@ class TaskHandler:
             return
         task.task_name = new_task_name if new_task_name else \
             task.task_name
+        self.cache.reindex(task)
 
     def update_description(self, task):
         """
@@ -194,6 +1426,7 @@ class TaskHandler:
         if self.validate_due_date_input(new_due_date):
             task.due_date = new_due_date if new_due_date else\
                 task.due_date
+            self.cache.reindex(task)
         else:
             print('No new due date entered or invalid date format. Due '
                   'date remains unchanged.')
@@ -211,6 +1444,7 @@ class TaskHandler:
                 new_priority = int(new_priority)
                 if 1 <= new_priority <= 10:
                     task.priority = new_priority
+                    self.cache.reindex(task)
                 else:
                     print('Invalid priority number. Task priority '
                           'remains unchanged.')
@@ -220,17 +1454,23 @@ class TaskHandler:
 
     def update_worksheet_data(self):
         """
-        Method to update worksheet with task data. Clears existing data, adds
-        header row and append rows for each task.
+        Method to update worksheet with task data. Writes the header row and
+        a row for each task in one batched write.
         """
-        self.worksheet.clear()
-        header_row = ['todo_title', 'task_name', 'description', 'due date',
-                      'priority']
-        self.worksheet.append_row(header_row)
-        for task in self.tasks:
-            row = [self.worksheet.title, task.task_name, task.description,
-                   task.due_date, task.priority]
-            self.worksheet.append_row(row)
+        self.save_changes(self.cache.reorder, list(self.tasks))
+
+    def save_changes(self, change, *args):
+        """
+        Apply a change to the task cache. The cache writes it to the
+        worksheet according to the flush policy, and errors from writing are
+        shown to the user. Returns what change returns, or None if writing
+        failed.
+        """
+        try:
+            return change(*args)
+        except StorageError as e:
+            print(f'{e} error saving changes. They will be saved later.')
+            return None
 
     def sort_tasks(self):
         """
@@ -239,18 +1479,16 @@ class TaskHandler:
         - sort by task name
         - sort by due date
         - sort by priority
-        The method then sorts the tasks and update the worksheet.
-        Learned abourt lambda functions at https://www.freecodecamp.org/news/
-        python-lambda-functions/
+        - sort by priority, then due date, then task name
+        The tasks are then shown in the chosen order, which is kept as the
+        order of the task views. The worksheet is only rewritten in the new
+        order if the user chooses to save it.
         """
-        # Skip first row with categorie names
-        tasks = self.worksheet.get_all_values()[1:]
         self.load_tasks()
         if not self.tasks:
             print('No tasks available.')
             print()
             print('Going back to the main menu')
-            self.worksheet_handler.start_worksheet_loop()
             return None
         self.display_all_tasks()
         print('How would you like to sort your tasks?')
@@ -258,74 +1496,150 @@ class TaskHandler:
         print('2. Sort by due date (The earliest date on the top of the '
               'todo_list)')
         print('3. Sort by priority number (1 on the top of the todo-list.)')
+        print('4. Sort by priority number, then due date, then task name')
         while True:
             choice = input('Please enter the number of the sorting method '
                            'you choose: ')
             if choice.lower() == 'q':
                 print()
                 print('Going back to main menu')
-                self.worksheet_handler.start_worksheet_loop()
                 return None
-            if choice in ['1', '2', '3']:
+            if choice in SORT_CHOICES:
                 break
             print('Invalid choice. Please try again.')
-        # Initialize an empty list to store sorted tasks
-        sorted_tasks = []
-        if choice == '1':
-            # Sorted by the second element of each task
-            sorted_tasks = sorted(tasks, key=lambda x: x[1])
-        elif choice == '2':
-            # Sorted by the fourth element of each task
-            sorted_tasks = sorted(tasks, key=lambda x: datetime.strptime(
-                x[3], '%d/%m/%y') if x[3] else datetime.max)
-        elif choice == '3':
-            # Sorted by the fifth element of each task
-            sorted_tasks = sorted(tasks, key=lambda x: int(x[4]))
-        # Empty existing data in the worksheet
-        self.worksheet.clear()
-        self.worksheet.append_row(['todo_title', 'task', 'task_description',
-                                  'due_date', 'priority'])
-        for task in sorted_tasks:
-            self.worksheet.append_row(task)
+        self.view_keys = SORT_CHOICES[choice]
+        self.view = None
+        print()
+        for task in self.sorted_view():
+            print(task.task_summary())
         print('The tasks are sorted')
-        self.worksheet_handler.start_worksheet_loop()
+        save = input('Would you like to save this order in the to-do list? '
+                     'Saving rewrites the whole list. (y/n): ')
+        if save.lower() == 'y':
+            # Replace existing data in the worksheet with the sorted rows
+            self.save_changes(self.cache.reorder, list(self.sorted_view()))
+            print('The order is saved')
         return None
 
+    def agenda(self, view, days=7):
+        """
+        Returns the tasks of an agenda view, ordered by due date:
+        - overdue: due before today
+        - today: due today
+        - next: due from today through the next days days
+        The tasks are looked up in the due date index of the task cache, so
+        the worksheet is neither read again nor changed.
+        """
+        today = datetime.now().toordinal()
+        if view == 'overdue':
+            return self.cache.due_between(1, today - 1)
+        if view == 'today':
+            return self.cache.due_between(today, today)
+        return self.cache.due_between(today, today + days)
+
+    def display_agenda(self):
+        """
+        Display the overdue tasks, the tasks due today or the tasks due in
+        the next days, as the user chooses
+        """
+        print('Which tasks would you like to see?')
+        print('1. Overdue tasks')
+        print('2. Tasks due today')
+        print('3. Tasks due in the next days')
+        views = {'1': 'overdue', '2': 'today', '3': 'next'}
+        while True:
+            choice = input('Please enter the number of your choice: ')
+            if choice.lower() == 'q':
+                print()
+                print('Going back to main menu')
+                return
+            if choice in views:
+                break
+            print('Invalid choice. Please try again.')
+        days = 7
+        while views[choice] == 'next':
+            answer = input('How many days ahead? Press Enter for 7 days: ')
+            if answer.lower() == 'q':
+                print()
+                print('Going back to main menu')
+                return
+            if not answer:
+                break
+            if answer.isdigit():
+                days = int(answer)
+                break
+            print('Invalid number of days. Please try again.')
+        tasks = self.agenda(views[choice], days)
+        print()
+        if not tasks:
+            print('No tasks found.')
+        for task in tasks:
+            print(task.task_summary())
+
+    def display_next_tasks(self):
+        """
+        Display the tasks to do next, by priority and then due date, without
+        sorting the worksheet
+        """
+        while True:
+            answer = input('How many tasks would you like to see? Press '
+                           'Enter for 5 tasks: ')
+            if answer.lower() == 'q':
+                print()
+                print('Going back to main menu')
+                return
+            if not answer:
+                count = 5
+                break
+            if answer.isdigit():
+                count = int(answer)
+                break
+            print('Invalid number. Please try again.')
+        tasks = self.cache.next_tasks(count)
+        print()
+        if not tasks:
+            print('No tasks available.')
+        for task in tasks:
+            print(task.task_summary())
+
     def delete_task(self, row_to_delete_input):
         """
         Delete the task the user selects from the current worksheet.
         The method deletes the corresponding row to the task from the
         worksheet.The user can abort the action by pressing q.
         """
-        for i, task in enumerate(self.tasks):
-            if task.task_name.lower() == row_to_delete_input.lower():
-                self.tasks.pop(i)
-                print(f'Task {row_to_delete_input} was deleted.')
-                break
-        self.update_worksheet_data()
-        self.worksheet_handler.start_worksheet_loop()
+        task = self.find_task_by_name(row_to_delete_input)
+        if task:
+            self.save_changes(self.cache.remove, task)
+            print(f'Task {row_to_delete_input} was deleted.')
 
 
 class Sheet:
     """
-    Represent a Google sheets document.
+    Represent the storage holding the to-do lists, the 'todo--app' Google
+    sheets document or a local SQLite database. The storage is opened once
+    and shared by all Sheet instances.
     """
+    storage = None
+
     def __init__(self):
         """
-        Initialize a Sheet instance and open the 'todo--app' spreadsheet
+        Initialize a Sheet instance and open the storage backend
         """
         self.sheet = self.open_spreadsheet()
 
     def open_spreadsheet(self):
         """
-        Open the 'todo--app' spreadsheet.
-        Returns a tuple with opened spreadsheet.
+        Open the storage backend selected with the TODO_STORAGE environment
+        variable, by default the 'todo--app' spreadsheet.
+        Returns the opened storage backend.
         """
         try:
-            sheet = GSPREAD_CLIENT.open('todo--app')
-            return sheet
-        except gspread.exceptions.SpreadsheetNotFound as e:
-            print(f'Spreadsheet not found: {e}')
+            if Sheet.storage is None:
+                Sheet.storage = open_storage()
+            return Sheet.storage
+        except StorageError as e:
+            print(f'Storage could not be opened: {e}')
             print('Exiting the program. Press the red button to start the app'
                   'again.')
             sys.exit()
@@ -337,17 +1651,35 @@ class Sheet:
         print('Linter method')
 
 
+@METRICS.instrument
 class WorksheetHandler:
     """
     Class for handling worksheets.
     """
-    def __init__(self, sheet):
-        self.sheet = sheet
+    # States of the main loop
+    MAIN_MENU = 'main_menu'
+    TASK_MENU = 'task_menu'
+    EXIT = 'exit'
+
+    def __init__(self, sheet=None, session=None):
+        # Without a session the handler gets its own session for sheet
+        if session is None:
+            session = Session(sheet)
+            session.handler = self
+        self.session = session
         self.worksheet_handler = None
         self.task_handler = None
+        self.todo_list = None
         self.user_input_handler = UserInputHandler(self, self.task_handler,
                                                    None)
 
+    @property
+    def sheet(self):
+        """
+        The storage of the session, opened the first time it is used
+        """
+        return self.session.sheet
+
     def get_worksheet(self, worksheet_name):
         """
         Retrieve a worksheet form Google Sheets.
@@ -355,17 +1687,15 @@ class WorksheetHandler:
         Returns the worksheet requested or None.
         """
         try:
-            worksheets = self.sheet.worksheets()
-            for worksheet in worksheets:
-                if worksheet.title == worksheet_name:
-                    print(f'{worksheet_name} was got')
-                    return worksheet
-        except gspread.exceptions.WorksheetNotFound:
+            if worksheet_name in self.sheet.list_names():
+                worksheet = self.sheet.open_list(worksheet_name)
+                print(f'{worksheet_name} was got')
+                return worksheet
+        except ListNotFound:
             print(f'To-do ist not found: {worksheet_name}. Going back to main '
                   'menu')
-            self.start_worksheet_loop()
             return None
-        except gspread.exceptions.APIError as e:
+        except StorageError as e:
             print(f'Error getting worksheet: {e}')
         return None
 
@@ -375,65 +1705,43 @@ class WorksheetHandler:
         Returns the new worksheet.
         """
         try:
-            existing_worksheets = self.sheet.worksheets()
-            for existing_worksheet in existing_worksheets:
-                if existing_worksheet.title == worksheet_name:
-                    print(f'To-do list {worksheet_name} already exist. Chose '
-                          'another name for the worksheet.')
-                    return None
-            worksheet = self.sheet.add_worksheet(title=worksheet_name,
-                                                 rows='20', cols='10')
-            worksheet.row_values(1)
-            worksheet.insert_row(['todo_title', 'task_name', 'description',
-                                  'due_date', 'priority'], 1)
+            if worksheet_name in self.sheet.list_names():
+                print(f'To-do list {worksheet_name} already exist. Chose '
+                      'another name for the worksheet.')
+                return None
+            worksheet = self.sheet.create_list(worksheet_name)
             print(f'To-do list {worksheet_name} was created')
-            self.task_handler = TaskHandler(worksheet, self.worksheet_handler,
-                                            self.user_input_handler)
+            # A new worksheet has no tasks, so there is nothing to load
+            TaskCache.for_worksheet(worksheet).start_empty()
             return worksheet
-        except gspread.exceptions.APIError as e:
+        except StorageError as e:
             print(f'Error creating worksheet: {e}')
             print()
             print('Going back to main menu')
-            self.start_worksheet_loop()
             return None
 
-    def open_worksheet(self, worksheet_name, worksheet_handler):
+    def open_worksheet(self, worksheet_name):
         """
         Open a specific worksheet in Google Sheets. Argument is the name of
-        the worksheet.
+        the worksheet. The to-do list of the worksheet, with its handlers, is
+        taken from the session and kept in todo_list for the task menu.
+        Returns the worksheet or None.
         """
         try:
-            worksheet = self.sheet.worksheet(worksheet_name)
+            todo_list = self.session.todo_list_for(worksheet_name)
             print(f'{worksheet_name} was opened')
-            self.task_handler = TaskHandler(worksheet, self,
-                                            self.user_input_handler)
-            self.user_input_handler.task_handler = self.task_handler
-            # Creating a default Task instance
-            self.user_input_handler = UserInputHandler(self,
-                                                       self.task_handler,
-                                                       Task('', '', '', 10))
-            self.task_handler.load_tasks()
-            # Create a dictionary to hold references to objects
-            settings = {
-                'user_input_handler': self.user_input_handler,
-                'task_handler': self.task_handler,
-                'worksheet': worksheet,
-                'worksheet_name': worksheet_name,
-                'worksheet_handler': worksheet_handler
-            }
-            todo_list = TodoList(settings)
-            todo_list.display_choices_for_task()
-            return worksheet
-        except gspread.exceptions.WorksheetNotFound:
+            todo_list.task_handler.load_tasks()
+            self.task_handler = todo_list.task_handler
+            self.todo_list = todo_list
+            return todo_list.worksheet
+        except ListNotFound:
             print(f'To-do list not found: {worksheet_name}. Going back to main'
                   ' menu')
-            self.start_worksheet_loop()
             return None
-        except gspread.exceptions.APIError as e:
+        except StorageError as e:
             print(f'{e} error opening worksheet')
             print()
             print('Going back to main menu')
-            self.start_worksheet_loop()
             return None
 
     def display_existing_worksheets(self):
@@ -442,99 +1750,197 @@ class WorksheetHandler:
         worksheets.
         """
         try:
-            worksheets = self.sheet.worksheets()
-            worksheet_names = [worksheet.title for worksheet in worksheets]
+            worksheet_names = self.sheet.list_names()
             print('Your current todo-lists:')
             for name in worksheet_names:
                 print(name)
-        except gspread.exceptions.APIError as e:
+        except StorageError as e:
             print(f'{e} error displaying worksheets')
             print()
             print('Going back to main menu')
-            self.worksheet_handler.start_worksheet_loop()
+            raise ReturnToMainMenu from e
 
     def delete_worksheet(self, worksheet_delete):
         """
         Delete a worksheet of the users choice.
         """
         try:
-            worksheet = self.sheet.worksheet(worksheet_delete)
-            self.sheet.del_worksheet(worksheet)
+            self.sheet.delete_list(worksheet_delete)
+            self.session.forget(worksheet_delete)
             print(f'To-do list {worksheet_delete} was deleted.')
-        except gspread.exceptions.WorksheetNotFound:
+        except ListNotFound:
             print(f'To-do list not found: {worksheet_delete}')
-        except gspread.exceptions.APIError as e:
+        except StorageError as e:
             print(f'{e} error deleting worksheet')
             print('Going back to main menu')
-            self.worksheet_handler.start_worksheet_loop()
 
     def start_worksheet_loop(self):
         """
-        A loop that displays different options for the user on what to do with
-        the worksheets.
+        The main loop of the app, run as a state machine. Every state is a
+        method which returns the next state:
+        - main_menu: options for the user on what to do with the worksheets
+        - task_menu: options for the tasks of the opened worksheet
+        Going back to the main menu from anywhere raises ReturnToMainMenu,
+        which is caught here. The loop never calls itself, so the memory used
+        stays the same however long the session goes on. The loop ends when
+        there is no more input.
+        """
+        states = {
+            self.MAIN_MENU: self.display_main_menu,
+            self.TASK_MENU: self.display_task_menu,
+        }
+        state = self.MAIN_MENU
+        while state != self.EXIT:
+            try:
+                state = states[state]()
+            except ReturnToMainMenu:
+                state = self.MAIN_MENU
+            except EOFError:
+                state = self.EXIT
+        TaskCache.flush_all()
+
+    def display_task_menu(self):
         """
-        worksheet = None
-        while True:
-            title = """
+        State of the main loop showing the task menu of the opened worksheet.
+        Returns the next state.
+        """
+        todo_list, self.todo_list = self.todo_list, None
+        todo_list.display_choices_for_task()
+        return self.MAIN_MENU
+
+    def display_main_menu(self):
+        """
+        State of the main loop displaying different options for the user on
+        what to do with the worksheets. Returns the next state.
+        """
+        # Changes kept in the task caches until the user is back at the
+        # main menu are written now. The other policies have written them
+        # already or write them without making the user wait.
+        TaskCache.flush_all('exit')
+        title = """
  _____      _         _____
 |_   _|__ _| |___ ___|  _  |___ ___
   | || . | . | . |___|     | . | . |
   |_||___|___|___|   |__|__|  _|  _|
                            |_| |_|
 """
-            print(title)
-            print('Welcome to your to-do app! Here, you can create to-do '
-                  'lists, and within each list, you can efficiently manage '
-                  'your tasks by adding, updating, sorting, deleting, and '
-                  'viewing them.')
-            print()
-            print('What would you like to do? Choose one option by entering '
-                  'a number. You can press q whenever you want to get '
-                  'back to this main menu and make a new choice')
-            print('1. Create a new to-do list')
-            print('2. Open a specific to-do list. Here you can then modify '
-                  'your to-do list by handeling tasks in the to-do list')
-            print('3. Display a list of your current to-do list')
-            print('4. Delete a whole to-do list. If you do NOT want to delete '
-                  'a to-do list, press q to exit the program.')
-            worksheet_choice = input('Please enter your choice: \n')
-            print()
-            if worksheet_choice == '1':
-                worksheet_name = self.get_worksheet_name()
-                self.create_worksheet(worksheet_name)
-                worksheet_handler = WorksheetHandler(self.sheet)
-                self.task_handler = TaskHandler(worksheet, worksheet_handler,
-                                                self.user_input_handler)
-            elif worksheet_choice == '2':
-                worksheet_name = self.get_worksheet_name()
-                worksheet_handler = WorksheetHandler(self.sheet)
-                worksheet = worksheet_handler.open_worksheet(worksheet_name,
-                                                             worksheet_handler)
-            elif worksheet_choice == '3':
-                self.display_existing_worksheets()
-            elif worksheet_choice == '4':
-                print('Are you sure you want to delete a to-do list? Once '
-                      'you have deleted it, you can not get it back. If you '
-                      'do NOT want to delete a to-do list, press q.')
-                self.display_existing_worksheets()
-                while True:
-                    worksheet_delete = input('Please enter the name of the '
-                                             'to-do list you would like to '
-                                             'delete: \n').lower()
-                    if worksheet_delete.lower() == 'q':
-                        print()
-                        print('Going back to main menu')
-                        self.start_worksheet_loop()
-                        return None
-                    if worksheet_delete in [worksheet.title for worksheet
-                                            in self.sheet.worksheets()]:
-                        self.delete_worksheet(worksheet_delete)
-                        break
-                    print(f'{worksheet_delete} does not exist. Please try '
-                          'another to-do list name')
-            else:
-                print(f'{worksheet_choice} is not a valid choice. Please '
-                      'enter a valid choice.')
+        print(title)
+        print('Welcome to your to-do app! Here, you can create to-do '
+              'lists, and within each list, you can efficiently manage '
+              'your tasks by adding, updating, sorting, deleting, and '
+              'viewing them.')
+        print()
+        print('What would you like to do? Choose one option by entering '
+              'a number. You can press q whenever you want to get '
+              'back to this main menu and make a new choice')
+        print('1. Create a new to-do list')
+        print('2. Open a specific to-do list. Here you can then modify '
+              'your to-do list by handeling tasks in the to-do list')
+        print('3. Display a list of your current to-do list')
+        print('4. Delete a whole to-do list. If you do NOT want to delete '
+              'a to-do list, press q to exit the program.')
+        print('5. View the tasks of all to-do lists')
+        print('6. Search the tasks of all to-do lists')
+        report_startup_time()
+        worksheet_choice = input('Please enter your choice: \n')
+        print()
+        if worksheet_choice == '1':
+            worksheet_name = self.get_worksheet_name()
+            self.create_worksheet(worksheet_name)
+        elif worksheet_choice == '2':
+            worksheet_name = self.get_worksheet_name()
+            if self.open_worksheet(worksheet_name):
+                return self.TASK_MENU
+        elif worksheet_choice == '3':
+            self.display_existing_worksheets()
+        elif worksheet_choice == '4':
+            print('Are you sure you want to delete a to-do list? Once '
+                  'you have deleted it, you can not get it back. If you '
+                  'do NOT want to delete a to-do list, press q.')
+            self.display_existing_worksheets()
+            while True:
+                worksheet_delete = input('Please enter the name of the '
+                                         'to-do list you would like to '
+                                         'delete: \n').lower()
+                if worksheet_delete.lower() == 'q':
+                    print()
+                    print('Going back to main menu')
+                    return self.MAIN_MENU
+                if worksheet_delete in self.sheet.list_names():
+                    self.delete_worksheet(worksheet_delete)
+                    break
+                print(f'{worksheet_delete} does not exist. Please try '
+                      'another to-do list name')
+        elif worksheet_choice == '5':
+            self.display_all_lists_tasks()
+        elif worksheet_choice == '6':
+            self.search_all_lists()
+        else:
+            print(f'{worksheet_choice} is not a valid choice. Please '
+                  'enter a valid choice.')
+        return self.MAIN_MENU
+
+    def display_all_lists_tasks(self):
+        """
+        Display the tasks of all to-do lists in one view, sorted by priority,
+        then due date, then task name. All lists are loaded together instead
+        of one after the other.
+        """
+        try:
+            tasks_by_list = TaskCache.load_all(self.sheet)
+        except StorageError as e:
+            print(f'Error loading the to-do lists: {e}')
+            return
+        list_of_task = {}
+        for worksheet_name, tasks in tasks_by_list.items():
+            for task in tasks:
+                list_of_task[task] = worksheet_name
+        if not list_of_task:
+            print('No tasks available.')
+            return
+        print(f'Tasks of all {len(tasks_by_list)} to-do lists:')
+        for task in sort_tasks_by(list(list_of_task), SORT_CHOICES['4']):
+            print(f'{list_of_task[task]}: {task.task_summary()}')
+
+    def search_all_lists(self):
+        """
+        Ask for words, a priority range and a due date window and display
+        the matching tasks of all to-do lists
+        """
+        print('Search the tasks of all to-do lists. Press Enter to skip a '
+              'question.')
+        text = self.ask_search_input('Words in the task name or '
+                                     'description: ', str)
+        priorities = self.ask_search_input('Priority range, for example 1-3: ',
+                                           parse_priority_range)
+        first = self.ask_search_input('Due from (dd/mm/yy): ', parse_due_date)
+        last = self.ask_search_input('Due until (dd/mm/yy): ', parse_due_date)
+        try:
+            SEARCH_INDEX.refresh(self.sheet)
+        except StorageError as e:
+            print(f'Error loading the to-do lists: {e}')
+            return
+        found = SEARCH_INDEX.search(text, priorities, (first, last))
+        print()
+        print(f'{len(found)} tasks found')
+        for worksheet_name, task in found:
+            print(f'{worksheet_name}: {task.task_summary()}')
+
+    def ask_search_input(self, prompt, parse):
+        """
+        Ask for one search criterion until parse accepts the answer. Returns
+        the parsed answer. Pressing q goes back to the main menu.
+        """
+        while True:
+            answer = input(prompt).strip()
+            if answer.lower() == 'q':
+                print()
+                print('Going back to main menu')
+                raise ReturnToMainMenu
+            try:
+                return parse(answer)
+            except ValueError as e:
+                print(f'{e}. Please try again.')
 
     def get_worksheet_name(self):
         """
@@ -547,11 +1953,11 @@ class WorksheetHandler:
             if worksheet_name.lower() == 'q':
                 print()
                 print('Going back to main menu')
-                self.start_worksheet_loop()
-                return None
+                raise ReturnToMainMenu
             return worksheet_name
 
 
+@METRICS.instrument
 class UserInputHandler:
     """
     Class for handling user input
@@ -580,7 +1986,7 @@ class UserInputHandler:
             elif task_name.lower() == 'q':
                 print()
                 print('Going back to main menu')
-                self.worksheet_handler.start_worksheet_loop()
+                raise ReturnToMainMenu
             else:
                 return task_name
 
@@ -594,26 +2000,23 @@ class UserInputHandler:
             if description.lower() == 'q':
                 print()
                 print('Going back to main menu')
-                self.worksheet_handler.start_worksheet_loop()
+                raise ReturnToMainMenu
             return description
 
-    def get_due_date(self, worksheet):
+    def get_due_date(self):
         """
-        Method to prompt the user to enter a description for the task
+        Method to prompt the user to enter a due date for the task
         """
         while True:
             print()
             due_date = input('Please enter a due-date(format dd/mm/yy): \n')
-            task_handler = TaskHandler(worksheet, self.worksheet_handler, self)
             if due_date.lower() == 'q':
                 print()
                 print('Going back to main menu')
-                self.worksheet_handler.start_worksheet_loop()
-            elif due_date == '':
+                raise ReturnToMainMenu
+            if due_date == '':
                 return due_date
-            valid_due_date_input =\
-                task_handler.validate_due_date_input(due_date)
-            if valid_due_date_input:
+            if validate_due_date(due_date):
                 return due_date
             print('Invalid date format. Please try agian.')
 
@@ -628,7 +2031,7 @@ class UserInputHandler:
             if priority.lower() == 'q':
                 print()
                 print('Going back to main menu')
-                self.worksheet_handler.start_worksheet_loop()
+                raise ReturnToMainMenu
             if not priority:
                 priority = 10
                 print(f'The default value {priority} is set when you do '
@@ -642,7 +2045,7 @@ class UserInputHandler:
             except ValueError:
                 print('Invalid input. Please enter a valid number')
 
-    def get_add_task_input(self, worksheet):
+    def get_add_task_input(self):
         """
         Method to prompt the user to enter information to add a new task. The
         user is asked to enter information on task name, description, due date
@@ -659,7 +2062,7 @@ class UserInputHandler:
         description = self.get_descripton()
         if description is None:
             return None
-        due_date = self.get_due_date(worksheet)
+        due_date = self.get_due_date()
         if due_date is None:
             return None
         priority = self.get_priority()
@@ -682,12 +2085,12 @@ class UserInputHandler:
 
     def handle_exit_condition(self, user_input):
         """
-        The method handles the exit condition if user enter 'q'
+        The method handles the exit condition if user enter 'q' by going back
+        to the main menu. Returns False otherwise.
         """
         if str(user_input).lower() == 'q':
             print('Going back to the main menu')
-            self.worksheet_handler.start_worksheet_loop()
-            return True
+            raise ReturnToMainMenu
         return False
 
     def get_delete_task_input(self):
@@ -709,14 +2112,10 @@ class UserInputHandler:
             elif row_to_delete_input.lower() == 'q':
                 print()
                 print('Going back to main menu')
-                self.worksheet_handler.start_worksheet_loop()
                 return None
             else:
-                found_task = False
-                for task in self.task_handler.tasks:
-                    if task.task_name.lower() == row_to_delete_input:
-                        found_task = True
-                        break
+                found_task = self.task_handler.find_task_by_name(
+                    row_to_delete_input)
                 if not found_task:
                     print('Cant find task name.Please try agian')
                     print()
@@ -742,7 +2141,8 @@ class TodoList:
 
     def default_worksheet_handler(self):
         """
-        Create and return a default worksheet handler
+        Create and return a default worksheet handler, using the shared
+        storage
         """
         default_handler = WorksheetHandler(Sheet().sheet)
         return default_handler
@@ -757,6 +2157,9 @@ class TodoList:
         - update task
         - sort task
         - delete task
+        - view tasks
+        - view agenda
+        - view next tasks
         - quit
         Depending on the users choice other methods are called.
         """
@@ -769,6 +2172,8 @@ class TodoList:
         print('c. Sort tasks')
         print('d. Delete task')
         print('e. View current tasks')
+        print('f. View agenda (overdue, due today, due soon)')
+        print('g. View the next tasks to do')
         print('q. Quit')
         user_choice = self.user_input_handler.get_user_choice_for_task()
         self.handle_user_choice(user_choice)
@@ -776,52 +2181,577 @@ class TodoList:
     def handle_user_choice(self, choice):
         """
         Method to handle the user's choice for action in the to-do list.
+        After the action the method returns and the user is back at the main
+        menu.
         """
         while True:
             if choice == 'a':
                 task_data = \
-                    self.user_input_handler.get_add_task_input(self.worksheet)
+                    self.user_input_handler.get_add_task_input()
                 if task_data is not None:
                     self.task_handler.add_task(task_data,
                                                self.worksheet_name,
                                                self.worksheet)
-            elif choice == 'b':
+                return
+            if choice == 'b':
                 self.task_handler.display_all_tasks()
                 task_name_to_update = input('Please enter the name of the task'
                                             ' you would like to update: ')
                 if task_name_to_update.lower() == 'q':
                     print()
                     print('Going back to main menu')
-                    self.worksheet_handler.start_worksheet_loop()
                     return
                 self.task_handler.update_task(task_name_to_update)
-            elif choice == 'c':
+                return
+            if choice == 'c':
                 self.task_handler.sort_tasks()
-            elif choice == 'd':
-                task_to_delete = \
-                    self.user_input_handler.get_delete_task_input()
-                self.task_handler.delete_task(task_to_delete)
-            elif choice == 'e':
+                return
+            if choice == 'd':
+                # The task is deleted by get_delete_task_input
+                self.user_input_handler.get_delete_task_input()
+                return
+            if choice == 'e':
                 self.task_handler.display_all_tasks()
-                self.worksheet_handler.start_worksheet_loop()
-            elif choice == 'q':
+                return
+            if choice == 'f':
+                self.task_handler.display_agenda()
+                return
+            if choice == 'g':
+                self.task_handler.display_next_tasks()
+                return
+            if choice == 'q':
                 print()
                 print('Going back to main menu')
-                self.worksheet_handler.start_worksheet_loop()
                 return
-            else:
-                choice = input('Invalid choice. Please enter your choice '
-                               'again: ')
+            choice = input('Invalid choice. Please enter your choice '
+                           'again: ')
+
+
+class Session:
+    """
+    Class owning the objects of one user session: the storage, the
+    WorksheetHandler and, for every opened worksheet, one TodoList with its
+    TaskHandler and UserInputHandler. Everything is created on first use and
+    reused after that, so opening a to-do list again creates no new objects
+    and does not open the storage again. The Google Sheets storage only
+    authorizes and opens the spreadsheet when the first data is needed, so
+    the main menu is shown without waiting for the network.
+    """
+    def __init__(self, sheet=None):
+        self.sheet_handle = sheet
+        self.handler = None
+        self.todo_lists = {}
+
+    @property
+    def sheet(self):
+        """
+        The storage of the session, opened on first use
+        """
+        if self.sheet_handle is None:
+            self.sheet_handle = Sheet().sheet
+        return self.sheet_handle
+
+    @property
+    def worksheet_handler(self):
+        """
+        The WorksheetHandler of the session, created on first use
+        """
+        if self.handler is None:
+            self.handler = WorksheetHandler(session=self)
+        return self.handler
+
+    def todo_list_for(self, worksheet_name):
+        """
+        Returns the TodoList of a worksheet, which is created with its
+        handlers the first time the worksheet is opened. Raises ListNotFound
+        if there is no such worksheet.
+        """
+        todo_list = self.todo_lists.get(worksheet_name)
+        if todo_list is None:
+            worksheet = self.sheet.open_list(worksheet_name)
+            handler = self.worksheet_handler
+            # Creating a default Task instance
+            user_input_handler = UserInputHandler(handler, None,
+                                                  Task('', '', '', 10))
+            task_handler = TaskHandler(worksheet, handler, user_input_handler)
+            user_input_handler.task_handler = task_handler
+            # Create a dictionary to hold references to objects
+            settings = {
+                'user_input_handler': user_input_handler,
+                'task_handler': task_handler,
+                'worksheet': worksheet,
+                'worksheet_name': worksheet_name,
+                'worksheet_handler': handler
+            }
+            todo_list = TodoList(settings)
+            self.todo_lists[worksheet_name] = todo_list
+        return todo_list
+
+    def forget(self, worksheet_name):
+        """
+        Forget the TodoList and the cached tasks of a deleted worksheet
+        """
+        self.todo_lists.pop(worksheet_name, None)
+        TaskCache.drop(worksheet_name)
+
+
+@METRICS.instrument
+class TaskTransfer:
+    """
+    Class importing tasks from and exporting tasks to CSV and JSON Lines
+    files. The files are read and written one task at a time and the rows
+    are sent to the storage chunk_size rows at a time, so the memory used
+    does not depend on the size of the file or of the to-do list. Both
+    formats use the fields task_name, description, due_date and priority.
+    """
+    FIELDS = ('task_name', 'description', 'due_date', 'priority')
+
+    def __init__(self, session, chunk_size=500):
+        self.session = session
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def file_format(path, file_format=None):
+        """
+        Returns 'csv' or 'jsonl', taken from file_format if it is given and
+        from the file extension otherwise. Raises ValueError if the format
+        is unknown.
+        """
+        if file_format is None:
+            file_format = os.path.splitext(path)[1].lstrip('.').lower()
+            if file_format == 'json':
+                file_format = 'jsonl'
+        if file_format not in ('csv', 'jsonl'):
+            raise ValueError(f'Unknown file format for {path}. Use a .csv or '
+                             '.jsonl file.')
+        return file_format
+
+    def read_records(self, file, file_format):
+        """
+        Yields a (line number, record) tuple for every task in the file,
+        where record is a dictionary from field name to value
+        """
+        if file_format == 'csv':
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, record if isinstance(record, dict) else None
+
+    def task_row(self, record, list_name):
+        """
+        Returns the worksheet row of a record. Raises ValueError with the
+        reason if the record is not a valid task.
+        """
+        if record is None:
+            raise ValueError('The line is not a JSON object')
+        values = ['' if record.get(field) is None
+                  else str(record[field]).strip() for field in self.FIELDS]
+        task_name, description, due_date, priority = values
+        error = task_error(task_name, due_date, priority)
+        if error:
+            raise ValueError(error)
+        return [list_name, task_name, description, due_date,
+                priority or '10']
+
+    def open_or_create(self, list_name):
+        """
+        Returns the stored list called list_name, which is created if it
+        does not exist
+        """
+        storage = self.session.sheet
+        try:
+            return storage.open_list(list_name)
+        except ListNotFound:
+            print(f'To-do list {list_name} was created')
+            return storage.create_list(list_name)
+
+    def import_tasks(self, list_name, path, file_format=None):
+        """
+        Add the tasks of a file to the end of a to-do list. Invalid tasks
+        are reported with their line number and skipped. The path - reads
+        standard input. Returns the number of imported and skipped tasks.
+        """
+        file_format = self.file_format(path, file_format)
+        worksheet = self.open_or_create(list_name)
+        cache = TaskCache.caches.get(list_name)
+        if cache:
+            # Pending changes are written first to keep the rows in order
+            cache.flush()
+        imported = skipped = 0
+        chunk = []
+        with self.open_file(path, 'r') as file:
+            for number, record in self.read_records(file, file_format):
+                try:
+                    chunk.append(self.task_row(record, list_name))
+                except ValueError as e:
+                    print(f'Line {number}: {e}. The task is skipped.')
+                    skipped += 1
+                    continue
+                if len(chunk) == self.chunk_size:
+                    worksheet.append_rows(chunk)
+                    imported += len(chunk)
+                    chunk = []
+        if chunk:
+            worksheet.append_rows(chunk)
+            imported += len(chunk)
+        worksheet.finish_writes()
+        if cache:
+            cache.unload()
+        return imported, skipped
+
+    def export_tasks(self, list_name, path, file_format=None):
+        """
+        Write the tasks of a to-do list to a file. The path - writes to
+        standard output. Returns the number of exported tasks.
+        """
+        file_format = self.file_format(path, file_format)
+        worksheet = self.session.sheet.open_list(list_name)
+        cache = TaskCache.caches.get(list_name)
+        if cache:
+            cache.flush()
+        exported = 0
+        with self.open_file(path, 'w') as file:
+            writer = csv.writer(file) if file_format == 'csv' else None
+            if writer:
+                writer.writerow(self.FIELDS)
+            for row in worksheet.iter_rows(self.chunk_size):
+                fields = row[1:len(self.FIELDS) + 1]
+                if writer:
+                    writer.writerow(fields)
+                else:
+                    file.write(json.dumps(dict(zip(self.FIELDS, fields)))
+                               + '\n')
+                exported += 1
+        return exported
+
+    @staticmethod
+    def open_file(path, mode):
+        """
+        Returns the opened file, or standard input or output for the path -,
+        wrapped so closing it does not close the standard stream
+        """
+        if path == '-':
+            stream = sys.stdin if mode == 'r' else sys.stdout
+            return open(stream.fileno(), mode, newline='', closefd=False)
+        return open(path, mode, newline='', encoding='utf-8')
+
+
+# Sort orders of the sort command, as choices in SORT_CHOICES
+SORT_COMMAND_CHOICES = {'name': '1', 'due_date': '2', 'priority': '3',
+                        'combined': '4'}
+
+
+def build_parser():
+    """
+    Returns the parser of the command line. Without a command the
+    interactive app is started.
+    """
+    parser = argparse.ArgumentParser(
+        description='To-do app. Run without a command to use the menus.')
+    commands = parser.add_subparsers(dest='command')
+    add_parser = commands.add_parser('add', help='add a task to a list')
+    add_parser.add_argument('list', help='name of the to-do list')
+    add_parser.add_argument('name', help='name of the task')
+    update_parser = commands.add_parser(
+        'update', help='change the fields given of a task')
+    update_parser.add_argument('list', help='name of the to-do list')
+    update_parser.add_argument('name', help='name of the task')
+    update_parser.add_argument('--new-name', help='new name of the task')
+    for command in (add_parser, update_parser):
+        command.add_argument('--description', help='description of the task')
+        command.add_argument('--due-date', help='due date in the format '
+                             'dd/mm/yy')
+        command.add_argument('--priority', help='priority from 1 to 10, '
+                             'where 1 is top priority')
+    delete_parser = commands.add_parser('delete', help='delete a task')
+    delete_parser.add_argument('list', help='name of the to-do list')
+    delete_parser.add_argument('name', help='name of the task')
+    sort_parser = commands.add_parser(
+        'sort', help='save the tasks of a list in a new order')
+    sort_parser.add_argument('list', help='name of the to-do list')
+    sort_parser.add_argument('order', choices=SORT_COMMAND_CHOICES,
+                             help='combined sorts by priority, then due '
+                             'date, then task name')
+    list_parser = commands.add_parser('list', help='show the tasks of a list')
+    list_parser.add_argument('list', help='name of the to-do list')
+    list_parser.add_argument('--sort', choices=SORT_COMMAND_CHOICES,
+                             help='show the tasks in this order, without '
+                             'saving it')
+    agenda_parser = commands.add_parser(
+        'agenda', help='show the overdue tasks, the tasks due today or the '
+        'tasks due in the next days of a list')
+    agenda_parser.add_argument('list', help='name of the to-do list')
+    agenda_parser.add_argument('view', choices=('overdue', 'today', 'next'))
+    agenda_parser.add_argument('--days', type=int, default=7,
+                               help='days ahead of the next view, by '
+                               'default 7')
+    next_parser = commands.add_parser(
+        'next', help='show the tasks to do next, by priority and due date')
+    next_parser.add_argument('list', help='name of the to-do list')
+    next_parser.add_argument('-n', '--count', type=int, default=5,
+                             help='number of tasks, by default 5')
+    search_parser = commands.add_parser(
+        'search', help='search the tasks of all lists')
+    search_parser.add_argument('words', nargs='*', help='words which must be '
+                               'in the task name or description')
+    search_parser.add_argument('--priority', type=parse_priority_range,
+                               default=(1, 10), help='priority range, for '
+                               'example 1-3')
+    search_parser.add_argument('--due-from', type=parse_due_date,
+                               help='first due date, dd/mm/yy')
+    search_parser.add_argument('--due-until', type=parse_due_date,
+                               help='last due date, dd/mm/yy')
+    import_parser = commands.add_parser(
+        'import', help='add the tasks of a CSV or JSON Lines file to a list')
+    export_parser = commands.add_parser(
+        'export', help='write the tasks of a list to a CSV or JSON Lines file')
+    for command in (import_parser, export_parser):
+        command.add_argument('list', help='name of the to-do list')
+        command.add_argument('file', help='file path, or - for standard '
+                             'input or output')
+        command.add_argument('--format', choices=('csv', 'jsonl'),
+                             help='file format, by default taken from the '
+                             'file extension')
+    commands.add_parser(
+        'batch', help='run one command per line read from standard input, '
+        'for example: add Home "Buy milk" --priority 2')
+    return parser
+
+
+class CommandRunner:
+    """
+    Class running the commands given on the command line, or read from
+    standard input by the batch command, with one session. The changes are
+    kept in the task caches while the commands run and written when they are
+    done, so many changes to a list are written in a few batched requests.
+    Messages go to standard error, so standard output only has the output
+    of the list and export commands.
+    """
+    def __init__(self, session, parser):
+        self.session = session
+        self.parser = parser
+        self.transfer = TaskTransfer(session)
+
+    def task_handler(self, list_name):
+        """
+        Returns the TaskHandler of a to-do list. Raises ListNotFound if there
+        is no such list.
+        """
+        return self.session.todo_list_for(list_name).task_handler
+
+    def find_task(self, arguments):
+        """
+        Returns the task handler of the list and the task named in the
+        arguments. Raises ValueError if there is no such task.
+        """
+        task_handler = self.task_handler(arguments.list)
+        task = task_handler.find_task_by_name(arguments.name)
+        if task is None:
+            raise ValueError(f'Task {arguments.name} not found in '
+                             f'{arguments.list}')
+        return task_handler, task
+
+    def add(self, arguments):
+        """
+        Add a task to the end of a list
+        """
+        error = task_error(arguments.name, arguments.due_date,
+                           arguments.priority)
+        if error:
+            raise ValueError(error)
+        task_handler = self.task_handler(arguments.list)
+        task_handler.cache.add(Task(arguments.name,
+                                    arguments.description or '',
+                                    arguments.due_date or '',
+                                    arguments.priority or 10))
+        print(f'Task {arguments.name} added to {arguments.list}',
+              file=sys.stderr)
+
+    def update(self, arguments):
+        """
+        Change the fields of a task which are given in the arguments
+        """
+        task_handler, task = self.find_task(arguments)
+        task_name = arguments.new_name or task.task_name
+        due_date = arguments.due_date or task.due_date
+        priority = arguments.priority or task.priority
+        error = task_error(task_name, due_date, priority)
+        if error:
+            raise ValueError(error)
+        task.task_name = task_name
+        if arguments.description is not None:
+            task.description = arguments.description
+        task.due_date = due_date
+        task.priority = priority
+        task_handler.cache.mark_dirty(task)
+        print(f'Task {task_name} updated', file=sys.stderr)
+
+    def delete(self, arguments):
+        """
+        Delete a task from a list
+        """
+        task_handler, task = self.find_task(arguments)
+        task_handler.cache.remove(task)
+        print(f'Task {arguments.name} was deleted', file=sys.stderr)
+
+    def sort(self, arguments):
+        """
+        Sort the tasks of a list and save the new order
+        """
+        task_handler = self.task_handler(arguments.list)
+        keys = SORT_CHOICES[SORT_COMMAND_CHOICES[arguments.order]]
+        task_handler.cache.reorder(sort_tasks_by(task_handler.tasks, keys))
+        print(f'The tasks of {arguments.list} are sorted', file=sys.stderr)
+
+    def list_tasks(self, arguments):
+        """
+        Print the tasks of a list
+        """
+        task_handler = self.task_handler(arguments.list)
+        tasks = task_handler.tasks
+        if arguments.sort:
+            tasks = sort_tasks_by(
+                tasks, SORT_CHOICES[SORT_COMMAND_CHOICES[arguments.sort]])
+        for task in tasks:
+            print(task.task_summary())
+
+    def agenda(self, arguments):
+        """
+        Print the tasks of an agenda view of a list
+        """
+        task_handler = self.task_handler(arguments.list)
+        for task in task_handler.agenda(arguments.view, arguments.days):
+            print(task.task_summary())
+
+    def next_tasks(self, arguments):
+        """
+        Print the tasks to do next in a list
+        """
+        task_handler = self.task_handler(arguments.list)
+        for task in task_handler.cache.next_tasks(arguments.count):
+            print(task.task_summary())
+
+    def search(self, arguments):
+        """
+        Print the tasks of all lists matching the search
+        """
+        SEARCH_INDEX.refresh(self.session.sheet)
+        found = SEARCH_INDEX.search(' '.join(arguments.words),
+                                    arguments.priority,
+                                    (arguments.due_from, arguments.due_until))
+        for list_name, task in found:
+            print(f'{list_name}: {task.task_summary()}')
+
+    def import_tasks(self, arguments):
+        """
+        Add the tasks of a file to a list
+        """
+        imported, skipped = self.transfer.import_tasks(
+            arguments.list, arguments.file, arguments.format)
+        print(f'{imported} tasks imported to {arguments.list}, '
+              f'{skipped} skipped', file=sys.stderr)
+
+    def export_tasks(self, arguments):
+        """
+        Write the tasks of a list to a file
+        """
+        exported = self.transfer.export_tasks(
+            arguments.list, arguments.file, arguments.format)
+        print(f'{exported} tasks exported from {arguments.list}',
+              file=sys.stderr)
+
+    def batch(self, arguments):
+        """
+        Run every line of standard input as a command. Empty lines and lines
+        starting with # are skipped. Raises ValueError if a command failed.
+        """
+        failed = 0
+        for number, line in enumerate(sys.stdin, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                command = self.parser.parse_args(shlex.split(line))
+            except (SystemExit, ValueError):
+                # argparse has printed why the line is invalid
+                command = None
+            if command is None or command.command in (None, 'batch'):
+                print(f'Line {number}: invalid command', file=sys.stderr)
+                failed += 1
+            elif self.run_command(command):
+                failed += 1
+        if failed:
+            raise ValueError(f'{failed} commands failed')
+
+    def run_command(self, arguments):
+        """
+        Run one command. Errors are printed. Returns the exit status.
+        """
+        commands = {
+            'add': self.add,
+            'update': self.update,
+            'delete': self.delete,
+            'sort': self.sort,
+            'list': self.list_tasks,
+            'agenda': self.agenda,
+            'next': self.next_tasks,
+            'search': self.search,
+            'import': self.import_tasks,
+            'export': self.export_tasks,
+            'batch': self.batch,
+        }
+        try:
+            commands[arguments.command](arguments)
+        except ListNotFound:
+            print(f'To-do list not found: {arguments.list}', file=sys.stderr)
+            return 1
+        except (OSError, ValueError, StorageError) as e:
+            print(f'Error: {e}', file=sys.stderr)
+            return 1
+        return 0
+
+    def run(self, arguments):
+        """
+        Run a command and write the changes. Returns the exit status.
+        """
+        status = self.run_command(arguments)
+        for cache in list(TaskCache.caches.values()):
+            try:
+                cache.flush()
+            except StorageError as e:
+                print(f'{e} error saving {cache.worksheet.title}',
+                      file=sys.stderr)
+                status = 1
+        return status
 
 
 def main():
     """
-    The main function of the program witch initalizes Sheet, WorksheetHandler
-    and call method start_worksheet_loop()
+    The main function of the program witch initalizes a Session and call
+    method start_worksheet_loop() of its WorksheetHandler, or runs the
+    command given on the command line
     """
-    sheet = Sheet().sheet
-    worksheet_handler = WorksheetHandler(sheet)
-    worksheet_handler.start_worksheet_loop()
+    parser = build_parser()
+    arguments = parser.parse_args()
+    # Exit normally when the terminal is closed, so pending changes are saved
+    for signal_name in ('SIGTERM', 'SIGHUP'):
+        if hasattr(signal, signal_name):
+            signal.signal(getattr(signal, signal_name),
+                          lambda signum, frame: sys.exit(0))
+    METRICS.start()
+    session = Session()
+    if arguments.command:
+        # Changes are written once the commands are done
+        TaskCache.default_policy = ('exit', None)
+        sys.exit(CommandRunner(session, parser).run(arguments))
+    session.worksheet_handler.start_worksheet_loop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,247 @@
+"""
+This module contains a server hosting many sessions of the to-do app in one
+process. Every connection to the local socket gets its own session, with the
+same menus as when run.py is started in a terminal. The sessions share the
+opened storage and the task caches, so a new connection starts without
+loading Python, authorizing or opening the spreadsheet again, and a to-do
+list is kept in memory once however many users have it open.
+Start it with: python3 server.py [--socket PATH]
+"""
+import argparse
+import asyncio
+import codecs
+import os
+import queue
+import signal
+import stat
+import sys
+import threading
+import traceback
+import run
+from metrics import METRICS
+from storage import StorageError, open_storage
+
+SOCKET_PATH = os.environ.get('TODO_SERVER_SOCKET', 'todo.sock')
+
+
+class RoutedStream:
+    """
+    Class standing in for sys.stdin or sys.stdout. Every call is passed on
+    to the stream of the current thread, so print() and input() in a
+    session thread use the connection of that session. Threads without a
+    stream of their own, such as the server itself, use the original stream.
+    """
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def current(self):
+        """
+        Returns the stream of the current thread
+        """
+        return getattr(self.local, 'stream', self.default)
+
+    def write(self, text):
+        return self.current().write(text)
+
+    def flush(self):
+        return self.current().flush()
+
+    def readline(self, size=-1):
+        return self.current().readline(size)
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+class SessionOutput:
+    """
+    Output stream of a session. Text is sent to the connection from the
+    event loop, with line endings converted for the terminal.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+
+    def write(self, text):
+        data = text.replace('\n', '\r\n').encode(self.encoding)
+        self.loop.call_soon_threadsafe(self.send, data)
+        return len(text)
+
+    def send(self, data):
+        """
+        Send data to the connection, unless it has been closed
+        """
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def flush(self):
+        """
+        Nothing to flush, the text is sent when it is written
+        """
+
+    def close(self):
+        """
+        Close the connection from the event loop
+        """
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class TerminalSession:
+    """
+    Class running one session of the app in a thread of its own. The
+    connection sends the keys typed in the web terminal one by one, so the
+    session echoes them and collects them into lines, with backspace
+    deleting the last character, as the terminal driver did when every
+    session was a process of its own. Ctrl-C and Ctrl-D end the session.
+    """
+    def __init__(self, loop, writer):
+        self.output = SessionOutput(loop, writer)
+        self.lines = queue.Queue()
+        self.line = []
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.in_escape = False
+        self.last_char = ''
+
+    def readline(self, size=-1):
+        """
+        Returns the next line typed by the user, or an empty string when
+        the input has ended
+        """
+        line = self.lines.get()
+        if not line:
+            # Keep the end of input for the next read
+            self.lines.put(line)
+        return line
+
+    def feed(self, data):
+        """
+        Handle bytes received from the connection
+        """
+        for char in self.decoder.decode(data):
+            self.handle_key(char)
+
+    def handle_key(self, char):
+        """
+        Echo and edit the line for one typed character
+        """
+        last_char, self.last_char = self.last_char, char
+        if self.in_escape:
+            # Escape sequences of arrow and function keys end with a letter
+            # or ~, and are ignored
+            self.in_escape = not (char.isalpha() or char == '~')
+        elif char == '\x1b':
+            self.in_escape = True
+        elif char in '\r\n':
+            if char == '\n' and last_char == '\r':
+                return
+            self.output.write('\n')
+            self.lines.put(''.join(self.line) + '\n')
+            self.line.clear()
+        elif char in '\x7f\b':
+            if self.line:
+                self.line.pop()
+                self.output.write('\b \b')
+        elif char in '\x03\x04':
+            self.end_input()
+        elif char >= ' ':
+            self.line.append(char)
+            self.output.write(char)
+
+    def end_input(self):
+        """
+        End the input, which ends the session at the next prompt
+        """
+        self.lines.put('')
+
+    def run(self):
+        """
+        Run the menus of the app until the input ends, then close the
+        connection
+        """
+        sys.stdin.local.stream = self
+        sys.stdout.local.stream = self.output
+        try:
+            run.Session().worksheet_handler.start_worksheet_loop()
+        except SystemExit:
+            pass
+        except Exception:
+            traceback.print_exc(file=sys.__stderr__)
+            print('\nAn error occurred. Please connect again.')
+        finally:
+            self.output.close()
+
+
+async def handle_connection(reader, writer):
+    """
+    Start a session for a new connection and pass it what is typed
+    """
+    session = TerminalSession(asyncio.get_running_loop(), writer)
+    threading.Thread(target=session.run, daemon=True).start()
+    try:
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            session.feed(data)
+    except ConnectionError:
+        pass
+    finally:
+        session.end_input()
+
+
+def remove_stale_socket(path):
+    """
+    Remove the socket file left by a server which has stopped
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+async def serve(path):
+    """
+    Serve sessions on the Unix socket path until the server is stopped
+    """
+    remove_stale_socket(path)
+    server = await asyncio.start_unix_server(handle_connection, path)
+    loop = asyncio.get_running_loop()
+    for signal_name in ('SIGTERM', 'SIGHUP', 'SIGINT'):
+        loop.add_signal_handler(getattr(signal, signal_name), server.close)
+    print(f'Serving to-do app sessions on {path}')
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        remove_stale_socket(path)
+
+
+def main():
+    """
+    Open the storage once for all sessions and serve them
+    """
+    parser = argparse.ArgumentParser(
+        description='Serve sessions of the to-do app on a local socket.')
+    parser.add_argument('--socket', default=SOCKET_PATH,
+                        help='path of the Unix socket, by default '
+                        'TODO_SERVER_SOCKET or todo.sock')
+    arguments = parser.parse_args()
+    try:
+        run.Sheet.storage = open_storage()
+    except StorageError as e:
+        print(f'Storage could not be opened: {e}')
+        sys.exit(1)
+    METRICS.start()
+    sys.stdin = RoutedStream(sys.stdin)
+    sys.stdout = RoutedStream(sys.stdout)
+    asyncio.run(serve(arguments.socket))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,921 @@
+"""
+This module contains the storage backends of the to-do app. A backend stores
+the to-do lists and the task rows inside of every to-do list. The Google
+Sheets backend keeps every to-do list in a worksheet of the 'todo--app'
+spreadsheet and the SQLite backend keeps them in a local database file.
+The backend is chosen at startup with the TODO_STORAGE environment variable
+('sheets' or 'sqlite').
+"""
+import contextlib
+import itertools
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import gspread
+from google.oauth2.service_account import Credentials
+from gspread.utils import absolute_range_name
+from metrics import METRICS, count_cells
+
+# Section of code taken from the Love Sandwich project
+SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+    ]
+# End of section code from the Love Sandwich project
+
+SPREADSHEET_NAME = 'todo--app'
+HEADER_ROW = ['todo_title', 'task_name', 'description', 'due_date',
+              'priority']
+# Column F of a worksheet holds the stamp of every task row, a random token
+# which is replaced whenever the app writes the row, and cell F1 the stamp of
+# the whole list, which is replaced whenever the app writes to the list
+STAMP_INDEX = len(HEADER_ROW)
+STAMP_CELL = 'F1'
+
+
+class StorageError(Exception):
+    """
+    Raised when a storage backend fails to read or write data.
+    """
+
+
+class ListNotFound(StorageError):
+    """
+    Raised when a to-do list does not exist in the storage backend.
+    """
+
+
+def clean_row(row):
+    """
+    Returns the row with every cell as a string, where None is replaced with
+    an empty string, as Google Sheets returns the cells.
+    """
+    return ['' if item is None else str(item) for item in row]
+
+
+def new_stamp():
+    """
+    Returns a new random stamp for a row or a list
+    """
+    return os.urandom(6).hex()
+
+
+def stamp_of(row):
+    """
+    Returns the stamp in a worksheet row, or an empty string if it has none
+    """
+    return row[STAMP_INDEX] if len(row) > STAMP_INDEX else ''
+
+
+class StoredList:
+    """
+    Interface for a to-do list in a storage backend. Rows are the task rows
+    of the list without the header row, and row numbers count from 0 at the
+    first task row.
+    """
+    title = None
+
+    def load_rows(self):
+        """
+        Returns all task rows of the to-do list
+        """
+        raise NotImplementedError
+
+    def load_changed_rows(self):
+        """
+        Returns all task rows of the to-do list if it may have changed since
+        it was last read or written through this object, or None if it has
+        not. Backends without a cheap way to tell return the rows every time.
+        """
+        return self.load_rows()
+
+    def remember_rows(self, rows):
+        """
+        Called with the task rows of the list read by
+        StorageBackend.load_lists, so load_changed_rows can tell changes
+        made after they were read
+        """
+
+    def check_rows(self, numbers):
+        """
+        Returns True if the rows with the given row numbers are still the
+        rows last read or written through this object, so they can be
+        updated and deleted by their numbers. Backends whose rows are only
+        changed through this object always return True.
+        """
+        return True
+
+    def iter_rows(self, chunk_size=500):
+        """
+        Yields the task rows of the to-do list one by one. The rows are read
+        chunk_size rows at a time where the backend supports it, so a large
+        list is never held in memory at once.
+        """
+        yield from self.load_rows()
+
+    def append_rows(self, rows):
+        """
+        Add rows to the end of the to-do list
+        """
+        raise NotImplementedError
+
+    def replace_rows(self, rows):
+        """
+        Replace all task rows of the to-do list with rows
+        """
+        raise NotImplementedError
+
+    def update_rows(self, rows):
+        """
+        Overwrite single task rows. rows is a dictionary from row number to
+        the new row.
+        """
+        raise NotImplementedError
+
+    def delete_rows(self, start, stop):
+        """
+        Delete the task rows from row start up to, but not including, row
+        stop
+        """
+        raise NotImplementedError
+
+    def finish_writes(self):
+        """
+        Called after a group of writes, for backends which mark the list as
+        changed once per group
+        """
+
+
+class StorageBackend:
+    """
+    Interface for a storage backend holding a number of to-do lists.
+    """
+    def list_names(self):
+        """
+        Returns the names of the existing to-do lists
+        """
+        raise NotImplementedError
+
+    def create_list(self, name):
+        """
+        Create a new to-do list with a header row. Returns the new list.
+        """
+        raise NotImplementedError
+
+    def open_list(self, name):
+        """
+        Returns the to-do list called name. Raises ListNotFound if there is
+        no such list.
+        """
+        raise NotImplementedError
+
+    def delete_list(self, name):
+        """
+        Delete the to-do list called name. Raises ListNotFound if there is no
+        such list.
+        """
+        raise NotImplementedError
+
+    def load_lists(self, names, max_workers=8):
+        """
+        Returns a dictionary from list name to the task rows of the list, for
+        every name in names. The lists are read at the same time by up to
+        max_workers threads, so reading many lists takes about as long as
+        reading the slowest one.
+        """
+        names = list(names)
+        if not names:
+            return {}
+        with ThreadPoolExecutor(min(max_workers, len(names))) as pool:
+            tables = pool.map(lambda name: self.open_list(name).load_rows(),
+                              names)
+            return dict(zip(names, tables))
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of API calls. A token is added every
+    60 / requests_per_minute seconds, up to burst tokens. Every call takes a
+    token and waits for it if the bucket is empty, so a burst of calls is
+    spread out over time instead of being rejected by the quota.
+    """
+    def __init__(self, requests_per_minute, burst=10):
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until it is available
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token is reserved now, so waiting callers keep their order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ReadCoalescer:
+    """
+    Class sharing the result of a read between callers. When a read is
+    asked for while the same read is already running in another thread,
+    the caller waits for that read instead of making its own request.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def call(self, key, function):
+        """
+        Returns the result of function(), or of the running call with the
+        same key. An error of the call is raised in every waiting caller.
+        """
+        with self.lock:
+            call = self.running.get(key)
+            first = call is None
+            if first:
+                call = self.running[key] = {'done': threading.Event()}
+        if not first:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = function()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.running[key]
+            call['done'].set()
+
+
+# The Sheets API allows 60 requests per minute per user. Set
+# TODO_API_RATE_LIMIT to another number of requests per minute, or to 0 to
+# turn the limiter off.
+API_RATE_LIMIT = float(os.environ.get('TODO_API_RATE_LIMIT', 60))
+RATE_LIMITER = RateLimiter(API_RATE_LIMIT) if API_RATE_LIMIT > 0 else None
+READS = ReadCoalescer()
+# Reads which are coalesced when the same read is already running
+READ_METHODS = {'get_all_values', 'worksheets'}
+# Calls which give the same result when they are repeated, so they are also
+# retried after a server error. Other calls are only retried when the quota
+# rejected them, as the request may have been carried out anyway.
+IDEMPOTENT_METHODS = READ_METHODS | {'open', 'open_by_key', 'get',
+                                     'batch_get',
+                                     'values_batch_get', 'resize', 'update',
+                                     'batch_update'}
+# Calls which send one row instead of a list of rows
+ROW_METHODS = {'append_row', 'insert_row'}
+MAX_RETRIES = 5
+MAX_BACKOFF = 32
+
+
+def retry_delay(attempt):
+    """
+    Returns the seconds to wait before retry number attempt, counted from
+    0: exponential backoff with up to one second of random jitter
+    """
+    return min(2 ** attempt + random.random(), MAX_BACKOFF)
+
+
+def should_retry(error, method):
+    """
+    Returns True if the gspread APIError may go away when method is called
+    again: quota errors (HTTP 429) always, server errors (HTTP 5xx) for
+    idempotent calls
+    """
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status == 429:
+        return True
+    return (status is not None and status >= 500
+            and method.__name__ in IDEMPOTENT_METHODS)
+
+
+def call_api(method, *args, **kwargs):
+    """
+    Call a gspread method, count the API call and translate gspread errors
+    into storage errors. The calls are rate limited, quota and server errors
+    are retried with backoff, and identical reads running at the same time
+    are made once.
+    """
+    if method.__name__ in READ_METHODS and not kwargs:
+        key = (id(method.__self__), method.__name__, args)
+        return READS.call(key, lambda: request_api(method, *args))
+    return request_api(method, *args, **kwargs)
+
+
+def request_api(method, *args, **kwargs):
+    """
+    Make the API request of call_api, retrying it when should_retry allows
+    """
+    attempt = 0
+    while True:
+        if RATE_LIMITER is not None:
+            RATE_LIMITER.acquire()
+        try:
+            if METRICS.enabled:
+                return measure_request(method, *args, **kwargs)
+            return method(*args, **kwargs)
+        except gspread.exceptions.WorksheetNotFound as e:
+            raise ListNotFound(str(e)) from e
+        except gspread.exceptions.SpreadsheetNotFound as e:
+            raise StorageError(f'Spreadsheet not found: {e}') from e
+        except gspread.exceptions.APIError as e:
+            if attempt == MAX_RETRIES or not should_retry(e, method):
+                raise StorageError(str(e)) from e
+        time.sleep(retry_delay(attempt))
+        attempt += 1
+
+
+def measure_request(method, *args, **kwargs):
+    """
+    Make one API request and record its latency and the cells sent and
+    received in the metrics, also when it fails
+    """
+    start = time.perf_counter()
+    result = None
+    try:
+        result = method(*args, **kwargs)
+        return result
+    finally:
+        elapsed = time.perf_counter() - start
+        if method.__name__ in ROW_METHODS:
+            cells_sent = len(args[0]) if args else 0
+        else:
+            cells_sent = sum(count_cells(value) for value
+                             in (*args, *kwargs.values()))
+        METRICS.record_api(method.__name__, elapsed, cells_sent,
+                           count_cells(result))
+
+
+class GspreadList(StoredList):
+    """
+    A to-do list kept in a worksheet, where the first row is the header row.
+    Every write replaces the stamps of the written rows and the stamp of the
+    list. The rows last read or written are kept by their row stamps, so
+    load_changed_rows only reads the list stamp when nothing has changed,
+    and otherwise the row stamps and the rows with stamps it does not know.
+    Rows are only kept once the list has been read, so writing to a list
+    which is never read, as an import does, keeps nothing in memory.
+    """
+    # Rows checked by reading their own stamps, more are checked by reading
+    # all stamps, as every row is a range of the request URL
+    CHECKED_ROWS = 50
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.title = worksheet.title
+        self.known_rows = {}
+        # The row stamps in worksheet order after the last read or write,
+        # None until the list is read
+        self.order = None
+        # The list stamp of the known rows, None when they must be checked
+        self.stamp = None
+        # Set by writes which could not replace the list stamp themselves
+        self.stamp_pending = False
+
+    def load_rows(self):
+        table = call_api(self.worksheet.get_all_values)
+        self.stamp = stamp_of(table[0]) if table else ''
+        self.known_rows = {stamp_of(row): row for row in table[1:]
+                           if stamp_of(row)}
+        self.order = [stamp_of(row) for row in table[1:]]
+        return table[1:]
+
+    def load_changed_rows(self):
+        if self.order is None:
+            return self.load_rows()
+        value = call_api(self.worksheet.get, STAMP_CELL)
+        stamp = value[0][0] if value and value[0] else ''
+        if stamp == self.stamp:
+            return None
+        stamps = self.read_stamps()
+        if stamps == self.order and all(stamps):
+            # Only changed by the writes made through this object
+            self.stamp = stamp
+            return None
+        rows = []
+        missing = []
+        for number, row_stamp in enumerate(stamps):
+            row = self.known_rows.pop(row_stamp, None)
+            if row is None:
+                missing.append(number)
+            rows.append(row)
+        if missing:
+            # The missing rows are read as runs of adjacent rows, in one
+            # request
+            runs = []
+            for number in missing:
+                if runs and runs[-1][-1] == number - 1:
+                    runs[-1].append(number)
+                else:
+                    runs.append([number])
+            ranges = [f'A{run[0] + 2}:F{run[-1] + 2}' for run in runs]
+            for run, values in zip(runs, call_api(self.worksheet.batch_get,
+                                                  ranges)):
+                values = list(values) + [[]] * (len(run) - len(values))
+                for number, row in zip(run, values):
+                    rows[number] = row + [''] * (STAMP_INDEX + 1 - len(row))
+        self.known_rows = {stamp_of(row): row for row in rows
+                           if stamp_of(row)}
+        self.order = stamps
+        self.stamp = stamp
+        return rows
+
+    def read_stamps(self):
+        """
+        Returns the row stamps of all task rows, with an empty string for
+        the rows which have none
+        """
+        # The title column tells the number of rows, as rows written by
+        # others may have no stamp
+        titles, stamps = call_api(self.worksheet.batch_get, ['A2:A', 'F2:F'])
+        stamps = [cell[0] if cell else '' for cell in stamps]
+        return stamps + [''] * (len(titles) - len(stamps))
+
+    def check_rows(self, numbers):
+        # Only the stamps of the rows are read. Rows without a stamp cannot
+        # be told apart, so then all stamps must be the same as before.
+        if not numbers:
+            return True
+        if self.order is None or max(numbers) >= len(self.order):
+            return False
+        expected = [self.order[number] for number in numbers]
+        if not all(expected) or len(numbers) > self.CHECKED_ROWS:
+            return self.read_stamps() == self.order
+        values = call_api(self.worksheet.batch_get,
+                          [f'F{number + 2}' for number in numbers])
+        return [value[0][0] if value and value[0] else ''
+                for value in values] == expected
+
+    def remember_rows(self, rows):
+        # The list stamp was not read, so the row stamps are checked on the
+        # next load, but only rows changed since are read again
+        self.known_rows = {stamp_of(row): row for row in rows
+                           if stamp_of(row)}
+        self.order = [stamp_of(row) for row in rows]
+        self.stamp = None
+
+    def iter_rows(self, chunk_size=500):
+        # The task rows start at worksheet row 2. The API leaves out empty
+        # cells at the end of a row, so the rows are padded to full width.
+        first = 2
+        while True:
+            last = first + chunk_size - 1
+            rows = call_api(self.worksheet.get, f'A{first}:E{last}')
+            for row in rows:
+                yield row + [''] * (len(HEADER_ROW) - len(row))
+            if len(rows) < chunk_size:
+                return
+            first = last + 1
+
+    def stamped_row(self, row, stamp=None):
+        """
+        Returns the worksheet row of a task row with a row stamp, a new one
+        unless stamp is given, and keeps it as a known row
+        """
+        cells = clean_row(row)[:STAMP_INDEX]
+        cells += [''] * (STAMP_INDEX - len(cells))
+        cells.append(stamp or new_stamp())
+        if self.order is not None:
+            self.known_rows[cells[-1]] = cells
+        # The list may have been changed by others before this write, so
+        # it is checked on the next load
+        self.stamp = None
+        return cells
+
+    def append_rows(self, rows):
+        table = [self.stamped_row(row) for row in rows]
+        call_api(self.worksheet.append_rows, table)
+        if self.order is not None:
+            self.order.extend(stamp_of(row) for row in table)
+        self.stamp_pending = True
+
+    def replace_rows(self, rows):
+        # The worksheet is resized to fit the new table, which drops any rows
+        # left below it, and the whole table is then sent in one range
+        # update. Rows which are not changed, only moved, keep their stamps.
+        stamps = {}
+        for row_stamp, row in self.known_rows.items():
+            stamps.setdefault(tuple(row[:STAMP_INDEX]), []).append(row_stamp)
+        self.known_rows = {}
+        table = [HEADER_ROW + [new_stamp()]]
+        for row in rows:
+            unchanged = stamps.get(tuple(clean_row(row)[:STAMP_INDEX]))
+            table.append(self.stamped_row(
+                row, unchanged.pop() if unchanged else None))
+        call_api(self.worksheet.resize, rows=len(table))
+        call_api(self.worksheet.update, range_name='A1', values=table)
+        if self.order is not None:
+            self.order = [stamp_of(row) for row in table[1:]]
+        self.stamp_pending = False
+
+    def update_rows(self, rows):
+        if rows:
+            # Worksheet rows count from 1 and the first row is the header.
+            # All rows and the list stamp are sent in one batched request.
+            table = {number: self.stamped_row(row)
+                     for number, row in sorted(rows.items())}
+            call_api(self.worksheet.batch_update, [
+                {'range': STAMP_CELL, 'values': [[new_stamp()]]}] + [
+                {'range': f'A{number + 2}', 'values': [row]}
+                for number, row in table.items()])
+            for number, row in table.items():
+                if self.order is not None and number < len(self.order):
+                    self.order[number] = stamp_of(row)
+            self.stamp_pending = False
+
+    def delete_rows(self, start, stop):
+        if stop > start:
+            # Worksheet rows count from 1 and the first row is the header
+            call_api(self.worksheet.delete_rows, start + 2, stop + 1)
+            if self.order is not None:
+                del self.order[start:stop]
+            self.stamp = None
+            self.stamp_pending = True
+
+    def finish_writes(self):
+        if self.stamp_pending:
+            call_api(self.worksheet.update, range_name=STAMP_CELL,
+                     values=[[new_stamp()]])
+            self.stamp_pending = False
+
+
+class GspreadStorage(StorageBackend):
+    """
+    Storage backend keeping every to-do list in a worksheet of a Google
+    Sheets spreadsheet.
+    The spreadsheet is either given, or opened by the function opener the
+    first time it is used, so no credentials are read and no request is made
+    before the app needs data.
+    The worksheets of the spreadsheet are cached by title for ttl seconds
+    (TODO_METADATA_TTL, by default 60), so listing, opening and deleting
+    to-do lists do not fetch the spreadsheet metadata every time. Creating
+    and deleting a to-do list through the backend updates the cache.
+    """
+    # Lists read by one request of load_lists, kept small enough for the
+    # length limit of the request URL
+    RANGES_PER_REQUEST = 50
+
+    def __init__(self, spreadsheet=None, ttl=None, opener=None):
+        self.opened_spreadsheet = spreadsheet
+        self.opener = opener
+        self.open_lock = threading.Lock()
+        if ttl is None:
+            ttl = float(os.environ.get('TODO_METADATA_TTL', '60'))
+        self.ttl = ttl
+        self.worksheets = None
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, spreadsheet_name=SPREADSHEET_NAME,
+                creds_file='creds.json'):
+        """
+        Returns a GspreadStorage which authorizes with the service account
+        credentials in creds_file and opens the spreadsheet on first use.
+        When the TODO_SPREADSHEET_KEY environment variable is set, the
+        spreadsheet is opened by its key, which saves the search for the
+        spreadsheet name.
+        """
+        key = os.environ.get('TODO_SPREADSHEET_KEY')
+
+        def opener():
+            try:
+                # Section of code taken from the Love Sandwich project
+                creds = Credentials.from_service_account_file(creds_file)
+                scoped_creds = creds.with_scopes(SCOPE)
+                client = gspread.authorize(scoped_creds)
+                # End of section code from the Love Sandwich project
+            except (OSError, ValueError) as e:
+                raise StorageError(f'Credentials could not be read: {e}') \
+                    from e
+            if key:
+                return call_api(client.open_by_key, key)
+            return call_api(client.open, spreadsheet_name)
+        return cls(opener=opener)
+
+    @property
+    def spreadsheet(self):
+        """
+        The spreadsheet, opened on first use
+        """
+        with self.open_lock:
+            if self.opened_spreadsheet is None:
+                self.opened_spreadsheet = self.opener()
+            return self.opened_spreadsheet
+
+    def invalidate(self):
+        """
+        Forget the cached worksheets, so they are fetched on next use
+        """
+        with self.lock:
+            self.worksheets = None
+
+    def worksheets_by_title(self, refresh=False):
+        """
+        Returns a dictionary from title to worksheet, fetched from the
+        spreadsheet when the cache is empty, expired or refresh is True
+        """
+        with self.lock:
+            expired = time.monotonic() - self.fetched_at >= self.ttl
+            if refresh or expired or self.worksheets is None:
+                worksheets = call_api(self.spreadsheet.worksheets)
+                self.worksheets = {worksheet.title: worksheet
+                                   for worksheet in worksheets}
+                self.fetched_at = time.monotonic()
+            return self.worksheets
+
+    def find_worksheet(self, name):
+        """
+        Returns the worksheet called name. A name missing from the cache is
+        looked up once more in fresh metadata, in case another user created
+        it. Raises ListNotFound if there is no such worksheet.
+        """
+        worksheet = self.worksheets_by_title().get(name)
+        if worksheet is None:
+            worksheet = self.worksheets_by_title(refresh=True).get(name)
+        if worksheet is None:
+            raise ListNotFound(name)
+        return worksheet
+
+    def list_names(self):
+        return list(self.worksheets_by_title())
+
+    def create_list(self, name):
+        worksheet = call_api(self.spreadsheet.add_worksheet, title=name,
+                             rows='20', cols='10')
+        with self.lock:
+            if self.worksheets is not None:
+                self.worksheets[name] = worksheet
+        call_api(worksheet.insert_row, HEADER_ROW, 1)
+        return GspreadList(worksheet)
+
+    def open_list(self, name):
+        return GspreadList(self.find_worksheet(name))
+
+    def delete_list(self, name):
+        worksheet = self.find_worksheet(name)
+        try:
+            call_api(self.spreadsheet.del_worksheet, worksheet)
+        except StorageError:
+            # The cached worksheet may have been deleted by another user
+            self.invalidate()
+            raise
+        with self.lock:
+            if self.worksheets is not None:
+                self.worksheets.pop(name, None)
+
+    def load_lists(self, names, max_workers=8):
+        # The worksheets are read with one multi-range request per
+        # RANGES_PER_REQUEST lists, and the requests are sent in parallel
+        names = list(names)
+        chunks = [names[start:start + self.RANGES_PER_REQUEST]
+                  for start in range(0, len(names), self.RANGES_PER_REQUEST)]
+        if not chunks:
+            return {}
+
+        def load_chunk(chunk):
+            response = call_api(
+                self.spreadsheet.values_batch_get,
+                [absolute_range_name(name, 'A2:F') for name in chunk])
+            return [value_range.get('values', [])
+                    for value_range in response.get('valueRanges', [])]
+        tables = {}
+        with ThreadPoolExecutor(min(max_workers, len(chunks))) as pool:
+            for chunk, values in zip(chunks, pool.map(load_chunk, chunks)):
+                for name, rows in zip(chunk, values):
+                    # The API leaves out empty cells at the end of a row.
+                    # The rows keep their stamps for remember_rows.
+                    tables[name] = [row + [''] * (STAMP_INDEX + 1 - len(row))
+                                    for row in rows]
+        return tables
+
+
+@contextlib.contextmanager
+def sqlite_errors():
+    """
+    Translate the SQLite errors raised in the block into storage errors, as
+    call_api does for gspread errors
+    """
+    try:
+        yield
+    except sqlite3.Error as e:
+        raise StorageError(f'SQLite error: {e}') from e
+
+
+class SQLiteList(StoredList):
+    """
+    A to-do list kept in a SQLite database, where every task row is stored
+    with its position in the list. The lock of the storage is held while
+    the connection is used, and SQLite errors are raised as StorageError.
+    """
+    def __init__(self, connection, name, lock):
+        self.connection = connection
+        self.title = name
+        self.lock = lock
+        # The data version of the database when the rows were last read
+        self.data_version = None
+
+    def current_data_version(self):
+        """
+        Returns the data version of the database, which changes when another
+        connection, such as another process, commits a change
+        """
+        return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def load_rows(self):
+        with self.lock, sqlite_errors():
+            self.data_version = self.current_data_version()
+            cursor = self.connection.execute(
+                'SELECT todo_title, task_name, description, due_date, '
+                'priority FROM task_rows WHERE list_name = ? '
+                'ORDER BY position', (self.title,))
+            return [list(row) for row in cursor]
+
+    def remember_rows(self, rows):
+        # Read just after the rows, so a commit by another process in
+        # between is only seen with the next one
+        with self.lock, sqlite_errors():
+            self.data_version = self.current_data_version()
+
+    def check_rows(self, numbers):
+        # Any commit by another connection may have moved the rows
+        with self.lock, sqlite_errors():
+            return (self.data_version is not None
+                    and self.data_version == self.current_data_version())
+
+    def load_changed_rows(self):
+        # Changes made through this connection are already known to the
+        # caller
+        with self.lock, sqlite_errors():
+            if self.data_version == self.current_data_version():
+                return None
+            return self.load_rows()
+
+    def iter_rows(self, chunk_size=500):
+        # Every chunk is read with its own query, so the lock is not held
+        # while the caller handles the rows
+        start = 0
+        while True:
+            with self.lock, sqlite_errors():
+                rows = self.connection.execute(
+                    'SELECT todo_title, task_name, description, due_date, '
+                    'priority FROM task_rows WHERE list_name = ? '
+                    'AND position >= ? ORDER BY position LIMIT ?',
+                    (self.title, start, chunk_size)).fetchall()
+            for row in rows:
+                yield list(row)
+            if len(rows) < chunk_size:
+                return
+            start += chunk_size
+
+    def row_count(self):
+        """
+        Returns the number of task rows in the list
+        """
+        with self.lock, sqlite_errors():
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM task_rows WHERE list_name = ?',
+                (self.title,)).fetchone()[0]
+
+    def insert_rows(self, rows, start):
+        """
+        Store rows at the positions from start and onwards
+        """
+        self.connection.executemany(
+            'INSERT INTO task_rows VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [[self.title, start + i] + clean_row(row)
+             for i, row in enumerate(rows)])
+
+    def append_rows(self, rows):
+        with self.lock, sqlite_errors(), self.connection:
+            self.insert_rows(rows, self.row_count())
+
+    def replace_rows(self, rows):
+        with self.lock, sqlite_errors(), self.connection:
+            self.connection.execute(
+                'DELETE FROM task_rows WHERE list_name = ?', (self.title,))
+            self.insert_rows(rows, 0)
+
+    def update_rows(self, rows):
+        with self.lock, sqlite_errors(), self.connection:
+            self.connection.executemany(
+                'UPDATE task_rows SET todo_title = ?, task_name = ?, '
+                'description = ?, due_date = ?, priority = ? '
+                'WHERE list_name = ? AND position = ?',
+                [clean_row(row) + [self.title, number]
+                 for number, row in rows.items()])
+
+    def delete_rows(self, start, stop):
+        if stop <= start:
+            return
+        with self.lock, sqlite_errors(), self.connection:
+            self.connection.execute(
+                'DELETE FROM task_rows WHERE list_name = ? AND position >= ? '
+                'AND position < ?', (self.title, start, stop))
+            self.connection.execute(
+                'UPDATE task_rows SET position = position - ? '
+                'WHERE list_name = ? AND position >= ?',
+                (stop - start, self.title, stop))
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Storage backend keeping the to-do lists in a local SQLite database file.
+    The connection is shared by all threads, so it is only used while
+    holding the lock and a transaction is never mixed with the statements
+    of another thread.
+    """
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        with sqlite_errors():
+            # The handlers may be used from more than one thread
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            with self.connection:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS lists (name TEXT PRIMARY KEY)')
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS task_rows (list_name TEXT, '
+                    'position INTEGER, todo_title TEXT, task_name TEXT, '
+                    'description TEXT, due_date TEXT, priority TEXT)')
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS task_rows_position '
+                    'ON task_rows (list_name, position)')
+
+    def list_names(self):
+        with self.lock, sqlite_errors():
+            return [row[0] for row in self.connection.execute(
+                'SELECT name FROM lists ORDER BY rowid')]
+
+    def create_list(self, name):
+        with self.lock, sqlite_errors():
+            try:
+                with self.connection:
+                    self.connection.execute('INSERT INTO lists VALUES (?)',
+                                            (name,))
+            except sqlite3.IntegrityError as e:
+                raise StorageError(f'To-do list {name} already exists') \
+                    from e
+        return SQLiteList(self.connection, name, self.lock)
+
+    def open_list(self, name):
+        with self.lock, sqlite_errors():
+            found = self.connection.execute(
+                'SELECT 1 FROM lists WHERE name = ?', (name,)).fetchone()
+        if found is None:
+            raise ListNotFound(name)
+        return SQLiteList(self.connection, name, self.lock)
+
+    def delete_list(self, name):
+        with self.lock, sqlite_errors(), self.connection:
+            deleted = self.connection.execute(
+                'DELETE FROM lists WHERE name = ?', (name,)).rowcount
+            self.connection.execute(
+                'DELETE FROM task_rows WHERE list_name = ?', (name,))
+        if not deleted:
+            raise ListNotFound(name)
+
+    def load_lists(self, names, max_workers=8):
+        # One query reads the rows of all lists
+        tables = {name: [] for name in names}
+        with self.lock, sqlite_errors():
+            cursor = self.connection.execute(
+                'SELECT list_name, todo_title, task_name, description, '
+                'due_date, priority FROM task_rows '
+                'ORDER BY list_name, position')
+            for name, rows in itertools.groupby(cursor,
+                                                key=lambda row: row[0]):
+                if name in tables:
+                    tables[name] = [list(row[1:]) for row in rows]
+        return tables
+
+
+def open_storage(kind=None):
+    """
+    Open the storage backend of the given kind, 'sheets' or 'sqlite'. When no
+    kind is given the TODO_STORAGE environment variable is used, and the
+    SQLite database file is taken from TODO_SQLITE_PATH.
+    """
+    kind = kind or os.environ.get('TODO_STORAGE', 'sheets')
+    if kind == 'sqlite':
+        return SQLiteStorage(os.environ.get('TODO_SQLITE_PATH',
+                                            'todo.sqlite3'))
+    if kind == 'sheets':
+        return GspreadStorage.connect()
+    raise StorageError(f'Unknown storage backend: {kind}')
@@ -0,0 +1,43 @@
+"""
+Tests of the metrics, which count the API calls of every operation.
+"""
+import unittest
+from metrics import Metrics
+
+
+class ApiCallCountTest(unittest.TestCase):
+    """
+    Counting the API calls per operation without a metrics output
+    """
+    def test_counts_latest_run_and_total(self):
+        metrics = Metrics(count_api_calls=True)
+        self.assertTrue(metrics.enabled)
+
+        def operation(calls):
+            for _ in range(calls):
+                metrics.record_api('get', 0.001)
+
+        timed = metrics.timed('TaskHandler.load_tasks', operation)
+        timed(3)
+        timed(2)
+        self.assertEqual(metrics.api_call_summary(),
+                         'API calls per operation (latest run / total):\n'
+                         'TaskHandler.load_tasks: 2 / 5')
+
+    def test_nothing_is_written_without_output(self):
+        metrics = Metrics(count_api_calls=True)
+        metrics.start()
+        self.assertIsNone(metrics.exporter)
+        metrics.stop()
+
+    def test_stop_ends_the_exporter(self):
+        metrics = Metrics('json', path='/dev/null', interval=0.01)
+        metrics.start()
+        exporter = metrics.exporter
+        metrics.stop()
+        self.assertFalse(exporter.is_alive())
+        self.assertIsNone(metrics.exporter)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests of the storage backends. The Google Sheets backend runs against the
+in-memory fakes of the benchmark module and the SQLite backend
+against a database in a temporary directory.
+"""
+import os
+import tempfile
+import unittest
+import storage
+from benchmark import FakeApi, FakeWorksheet
+
+
+class SQLiteStorageTest(unittest.TestCase):
+    """
+    The SQLite backend
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'todo.sqlite3')
+
+    def test_database_which_cannot_be_opened(self):
+        with self.assertRaises(storage.StorageError):
+            storage.SQLiteStorage(os.path.join(self.path, 'missing', 'x.db'))
+
+    def test_errors_are_storage_errors(self):
+        sheet = storage.SQLiteStorage(self.path)
+        todo_list = sheet.create_list('home')
+        sheet.connection.close()
+        with self.assertRaises(storage.StorageError):
+            todo_list.load_rows()
+        with self.assertRaises(storage.StorageError):
+            todo_list.append_rows([['home', 'task', '', '', 10]])
+        with self.assertRaises(storage.StorageError):
+            sheet.list_names()
+
+    def test_existing_list(self):
+        sheet = storage.SQLiteStorage(self.path)
+        sheet.create_list('home')
+        with self.assertRaisesRegex(storage.StorageError, 'already exists'):
+            sheet.create_list('home')
+        sheet.connection.close()
+
+
+class RecordingWorksheet(FakeWorksheet):
+    """
+    FakeWorksheet keeping the ranges of every batch_get
+    """
+    def __init__(self, api, title, rows=None):
+        super().__init__(api, title, rows)
+        self.batches = []
+
+    def batch_get(self, ranges):
+        self.batches.append(list(ranges))
+        return super().batch_get(ranges)
+
+
+class LoadChangedRowsTest(unittest.TestCase):
+    """
+    GspreadList.load_changed_rows after changes made through another
+    GspreadList on the same worksheet, or by hand
+    """
+    def setUp(self):
+        rate_limiter = storage.RATE_LIMITER
+        storage.RATE_LIMITER = None
+        self.addCleanup(setattr, storage, 'RATE_LIMITER', rate_limiter)
+        self.api = FakeApi()
+        self.worksheet = RecordingWorksheet(
+            self.api, 'home', [storage.HEADER_ROW + [storage.new_stamp()]] + [
+                ['home', name, '', '', '10', storage.new_stamp()]
+                for name in ('a', 'b', 'c', 'd', 'e')])
+        self.mine = storage.GspreadList(self.worksheet)
+        self.theirs = storage.GspreadList(self.worksheet)
+        self.mine.load_rows()
+        self.theirs.load_rows()
+        self.worksheet.batches = []
+
+    def load(self):
+        """
+        Returns the rows of load_changed_rows and the API calls it made
+        """
+        calls = self.api.calls
+        rows = self.mine.load_changed_rows()
+        return rows, self.api.calls - calls
+
+    def names(self, rows):
+        return [row[1] for row in rows]
+
+    def test_unchanged(self):
+        self.assertEqual(self.load(), (None, 1))
+
+    def test_remote_update(self):
+        self.theirs.update_rows({2: ['home', 'changed', '', '', '1']})
+        rows, calls = self.load()
+        self.assertEqual(self.names(rows), ['a', 'b', 'changed', 'd', 'e'])
+        self.assertEqual(rows, self.worksheet.rows[1:])
+        # The list stamp, the row stamps and the changed row
+        self.assertEqual(calls, 3)
+        self.assertEqual(self.worksheet.batches[-1], ['A4:F4'])
+        self.assertEqual(self.load(), (None, 1))
+
+    def test_remote_append(self):
+        self.theirs.append_rows([['home', 'f', '', '', '10'],
+                                 ['home', 'g', '', '', '10']])
+        self.theirs.finish_writes()
+        rows, calls = self.load()
+        self.assertEqual(self.names(rows), ['a', 'b', 'c', 'd', 'e', 'f',
+                                            'g'])
+        self.assertEqual(calls, 3)
+        self.assertEqual(self.worksheet.batches[-1], ['A7:F8'])
+
+    def test_remote_delete(self):
+        self.theirs.delete_rows(1, 3)
+        self.theirs.finish_writes()
+        rows, calls = self.load()
+        self.assertEqual(self.names(rows), ['a', 'd', 'e'])
+        # No row is read again
+        self.assertEqual(calls, 2)
+
+    def test_remote_reorder(self):
+        self.theirs.replace_rows(list(reversed(self.theirs.load_rows())))
+        rows, calls = self.load()
+        self.assertEqual(self.names(rows), ['e', 'd', 'c', 'b', 'a'])
+        self.assertEqual(rows, self.worksheet.rows[1:])
+        # Moved rows keep their stamps, so no row is read again
+        self.assertEqual(calls, 2)
+
+    def test_unstamped_rows(self):
+        # Rows added and edited by hand have no stamp and no empty cells at
+        # the end
+        self.worksheet.rows[2] = ['home', 'edited']
+        self.worksheet.rows[5] = ['home', 'hand', 'x']
+        self.worksheet.rows.append(['home', 'new'])
+        self.worksheet.rows[0][storage.STAMP_INDEX] = storage.new_stamp()
+        rows, calls = self.load()
+        self.assertEqual(rows, [
+            self.worksheet.rows[1], ['home', 'edited', '', '', '', ''],
+            self.worksheet.rows[3], self.worksheet.rows[4],
+            ['home', 'hand', 'x', '', '', ''],
+            ['home', 'new', '', '', '', '']])
+        self.assertEqual(calls, 3)
+        # Adjacent missing rows are read as one range
+        self.assertEqual(self.worksheet.batches[-1], ['A3:F3', 'A6:F7'])
+        # Rows without a stamp are read again on every change
+        self.worksheet.rows[0][storage.STAMP_INDEX] = storage.new_stamp()
+        rows, calls = self.load()
+        self.assertEqual(self.names(rows),
+                         ['a', 'edited', 'c', 'd', 'hand', 'new'])
+        self.assertEqual(self.worksheet.batches[-1], ['A3:F3', 'A6:F7'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+"""
+Tests of the task cache, run against the in-memory FakeSpreadsheet of the
+benchmark module, so they need no credentials.
+"""
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import requests
+import storage
+from benchmark import FakeApi, FakeSpreadsheet
+from run import WRITER, BackgroundWriter, Task, TaskCache, WorksheetHandler
+
+
+def make_list(spreadsheet, title, names):
+    """
+    Add a worksheet called title with one task row for every name in names
+    """
+    worksheet = spreadsheet.add_worksheet(title, rows=20, cols=10)
+    worksheet.rows = [storage.HEADER_ROW + [storage.new_stamp()]] + [
+        [title, name, '', '', '10', storage.new_stamp()] for name in names]
+    return worksheet
+
+
+class TaskCacheTest(unittest.TestCase):
+    """
+    Base class making a fake spreadsheet for every test and forgetting the
+    task caches after it
+    """
+    def setUp(self):
+        self.rate_limiter = storage.RATE_LIMITER
+        storage.RATE_LIMITER = None
+        self.default_policy = TaskCache.default_policy
+        TaskCache.default_policy = ('immediate', None)
+        TaskCache.caches.clear()
+        self.api = FakeApi()
+        self.spreadsheet = FakeSpreadsheet(self.api)
+
+    def tearDown(self):
+        TaskCache.caches.clear()
+        TaskCache.default_policy = self.default_policy
+        storage.RATE_LIMITER = self.rate_limiter
+
+    def names(self, worksheet):
+        """
+        Returns the task names in the rows of a fake worksheet
+        """
+        return [row[1] for row in worksheet.rows[1:]]
+
+
+class LockOrderTest(TaskCacheTest):
+    """
+    Changes and flushes made from different threads at the same time
+    """
+    def test_add_while_flushing_all(self):
+        worksheet = make_list(self.spreadsheet, 'home', [])
+        cache = TaskCache.for_worksheet(storage.GspreadList(worksheet))
+        cache.get_tasks()
+        stop = threading.Event()
+
+        def add_tasks():
+            for number in range(200):
+                cache.add(Task(f'task {number}'))
+            stop.set()
+
+        def flush_all():
+            while not stop.is_set():
+                TaskCache.flush_all()
+
+        threads = [threading.Thread(target=add_tasks, daemon=True),
+                   threading.Thread(target=flush_all, daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertFalse(any(thread.is_alive() for thread in threads),
+                         'adding and flushing deadlocked')
+        self.assertEqual(self.names(worksheet),
+                         [f'task {number}' for number in range(200)])
+
+
+class ConcurrentEditorsTest(TaskCacheTest):
+    """
+    Two clients changing the same to-do list, each with its own cache
+    """
+    def caches(self):
+        """
+        Returns the caches of two clients of a list with tasks t0 to t3
+        """
+        make_list(self.spreadsheet, 'home', ['t0', 't1', 't2', 't3'])
+        caches = []
+        for _ in range(2):
+            sheet = storage.GspreadStorage(self.spreadsheet)
+            cache = TaskCache(sheet.open_list('home'))
+            cache.get_tasks()
+            caches.append(cache)
+        return caches
+
+    def test_update_after_other_deleted_row_above(self):
+        first, second = self.caches()
+        second.remove(second.find_by_name('t0'))
+        task = first.find_by_name('t1')
+        task.description = 'edited'
+        self.assertTrue(first.mark_dirty(task))
+        rows = self.spreadsheet.sheets['home'].rows[1:]
+        self.assertEqual([row[1] for row in rows], ['t1', 't2', 't3'])
+        self.assertEqual([row[2] for row in rows], ['edited', '', ''])
+        self.assertEqual(task.row, 0)
+
+    def test_delete_after_other_deleted_row_above(self):
+        first, second = self.caches()
+        second.remove(second.find_by_name('t0'))
+        first.remove(first.find_by_name('t2'))
+        self.assertEqual(self.names(self.spreadsheet.sheets['home']),
+                         ['t1', 't3'])
+        self.assertEqual([task.task_name for task in first.get_tasks()],
+                         ['t1', 't3'])
+
+    def test_delete_row_already_deleted_by_other(self):
+        first, second = self.caches()
+        second.remove(second.find_by_name('t1'))
+        first.remove(first.find_by_name('t1'))
+        self.assertEqual(self.names(self.spreadsheet.sheets['home']),
+                         ['t0', 't2', 't3'])
+
+    def test_update_task_edited_by_other(self):
+        first, second = self.caches()
+        second.remove(second.find_by_name('t0'))
+        task = second.find_by_name('t2')
+        task.priority = 1
+        second.mark_dirty(task)
+        task = first.find_by_name('t2')
+        task.description = 'edited'
+        first.mark_dirty(task)
+        rows = self.spreadsheet.sheets['home'].rows[1:]
+        self.assertEqual([row[1] for row in rows], ['t1', 't2', 't3'])
+        self.assertEqual(rows[1][2], 'edited')
+
+    def test_unstamped_rows(self):
+        worksheet = make_list(self.spreadsheet, 'home',
+                              ['t0', 't1', 't2', 't3'])
+        for row in worksheet.rows:
+            del row[storage.STAMP_INDEX:]
+        first, second = [TaskCache(storage.GspreadList(worksheet))
+                         for _ in range(2)]
+        first.get_tasks()
+        second.get_tasks()
+        second.remove(second.find_by_name('t0'))
+        first.remove(first.find_by_name('t2'))
+        self.assertEqual(self.names(worksheet), ['t1', 't3'])
+
+    def test_sqlite_clients(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'todo.sqlite3')
+            sheet = storage.SQLiteStorage(path)
+            sheet.create_list('home').append_rows(
+                [['home', name, '', '', 10] for name in ('t0', 't1', 't2')])
+            first = TaskCache(sheet.open_list('home'))
+            second = TaskCache(storage.SQLiteStorage(path).open_list('home'))
+            first.get_tasks()
+            second.get_tasks()
+            second.remove(second.find_by_name('t0'))
+            task = first.find_by_name('t1')
+            task.description = 'edited'
+            first.mark_dirty(task)
+            self.assertEqual(sheet.open_list('home').load_rows(),
+                             [['home', 't1', 'edited', '', '10'],
+                              ['home', 't2', '', '', '10']])
+            second.worksheet.connection.close()
+            sheet.connection.close()
+
+
+class SharedCacheTest(TaskCacheTest):
+    """
+    Sessions sharing one cache while others change the list
+    """
+    def test_edit_across_refresh(self):
+        worksheet = make_list(self.spreadsheet, 'home', ['t0', 't1', 't2'])
+        cache = TaskCache(storage.GspreadList(worksheet))
+        cache.get_tasks()
+        other = TaskCache(storage.GspreadList(worksheet))
+        other.get_tasks()
+        # A session starts editing t1, another refreshes the shared cache
+        # after others added and deleted tasks
+        task = cache.find_by_name('t1')
+        task.description = 'edited'
+        other.add(Task('t3'))
+        other.remove(other.find_by_name('t0'))
+        cache.checked_at = 0
+        cache.refresh()
+        self.assertTrue(cache.mark_dirty(task))
+        rows = worksheet.rows[1:]
+        self.assertEqual([row[1] for row in rows], ['t1', 't2', 't3'])
+        self.assertEqual(rows[0][2], 'edited')
+        self.assertEqual([task.task_name for task in cache.get_tasks()],
+                         ['t1', 't2', 't3'])
+
+    def test_edit_of_task_deleted_by_other(self):
+        worksheet = make_list(self.spreadsheet, 'home', ['t0', 't1'])
+        cache = TaskCache(storage.GspreadList(worksheet))
+        cache.get_tasks()
+        other = TaskCache(storage.GspreadList(worksheet))
+        other.get_tasks()
+        task = cache.find_by_name('t1')
+        task.description = 'edited'
+        other.remove(other.find_by_name('t1'))
+        cache.checked_at = 0
+        cache.refresh()
+        self.assertFalse(cache.mark_dirty(task))
+        self.assertEqual(self.names(worksheet), ['t0'])
+
+
+class BackgroundPolicyTest(TaskCacheTest):
+    """
+    Changes written by the background writer
+    """
+    def test_main_menu_does_not_wait_for_writer(self):
+        worksheet = make_list(self.spreadsheet, 'home', [])
+        cache = TaskCache(storage.GspreadList(worksheet),
+                          ('background', None))
+        TaskCache.caches['home'] = cache
+        cache.get_tasks()
+        self.api.latency = 0.5
+        shown = []
+        handler = WorksheetHandler(sheet=storage.GspreadStorage(
+            self.spreadsheet))
+        start = time.monotonic()
+        cache.add(Task('new task'))
+        with mock.patch('run.input', create=True,
+                        side_effect=lambda prompt: shown.append(
+                            time.monotonic() - start) or ''), \
+                contextlib.redirect_stdout(io.StringIO()):
+            handler.display_main_menu()
+        self.assertLess(shown[0], 0.25)
+        WRITER.drain()
+        self.assertEqual(self.names(worksheet), ['new task'])
+
+    def test_writer_survives_connection_error(self):
+        worksheet = make_list(self.spreadsheet, 'home', [])
+        cache = TaskCache(storage.GspreadList(worksheet), ('exit', None))
+        cache.get_tasks()
+        writer = BackgroundWriter(retries=0, exit_timeout=5)
+        cache.add(Task('new task'))
+        with mock.patch.object(
+                cache.worksheet, 'append_rows',
+                side_effect=requests.exceptions.ConnectionError('lost')), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            writer.submit(cache)
+            self.assertTrue(writer.drain(5))
+        self.assertIn('lost error saving home', output.getvalue())
+        self.assertTrue(writer.thread.is_alive())
+        self.assertTrue(cache.is_dirty())
+        writer.submit(cache)
+        start = time.monotonic()
+        writer.close()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.names(worksheet), ['new task'])
+
+    def test_close_gives_up_after_exit_timeout(self):
+        writer = BackgroundWriter(exit_timeout=0.1)
+        cache = mock.Mock()
+        cache.flush.side_effect = lambda: time.sleep(1)
+        writer.submit(cache)
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            writer.close()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()